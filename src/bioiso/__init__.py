@@ -1,8 +1,18 @@
-from bioiso.utils.bioisoUtils import Node, NodeCache, evaluate_side, timeout, \
-    searchSpaceSize, bioisosearchSpaceSize, searchSpaceSizeRecursive, bioisosearchSpaceSizeRecursive
+from bioiso.utils.bioisoUtils import Node, NodeCache, NodeCacheStore, BoundsFingerprint, INFEASIBLE, evaluate_side, \
+    timeout, searchSpaceSize, bioisosearchSpaceSize, searchSpaceSizeRecursive, bioisosearchSpaceSizeRecursive, \
+    SearchSpace, iterate_tree
+from bioiso.utils.resultsUtils import RESULTS_FORMATS, propagate_analysis, node_results, write_tree, write_tree_lines, \
+    tree_arrays, write_tree_arrays, write_results_file, load_results, load_frames, ResultsArrays, ResultsView
 from bioiso.wrappers.cobraWrapper import load, set_solver, get_products, get_reactants, get_reaction, \
     list_reactants_ids, list_products_ids, simulate_reaction, get_reactions_by_role, simulate_reactants, \
-    simulate_products, get_reactions_by_role_fast, set_objective_function, singleReactionKO
+    simulate_products, get_reactions_by_role_fast, set_objective_function, singleReactionKO, harvest_solution, \
+    harvest_masks, list_reactions_to_simulate, get_reactions, model_hash, get_reactions_roles, find_knockouts
+from bioiso.wrappers.indexWrapper import StoichiometricIndex, NetworkExpansion
+from bioiso.wrappers.solverWrapper import SolverEngine
+from bioiso.wrappers.capabilityWrapper import FluxCapabilities, maximize_capacities, screen_nodes
+from bioiso.wrappers.compressionWrapper import CompressedModel
+from bioiso.wrappers.parallelWrapper import new_pool, evaluate_tasks
 from bioiso.core.bioiso import BioISO
+from bioiso.core.knockoutScan import scan_knockouts, scan_index_name
 
 
@@ -1,13 +1,19 @@
-import json
+import uuid
+import weakref
 from bioiso import get_products, get_reactants, get_reaction, \
     list_reactants_ids, list_products_ids, simulate_reaction, get_reactions_by_role, simulate_reactants, \
-    simulate_products, get_reactions_by_role_fast
-from bioiso import Node, NodeCache, evaluate_side, timeout
+    simulate_products, get_reactions_by_role_fast, list_reactions_to_simulate, model_hash
+from bioiso import Node, NodeCache, NodeCacheStore, SearchSpace, timeout
+from bioiso import SolverEngine, StoichiometricIndex, NetworkExpansion, FluxCapabilities, CompressedModel, new_pool, \
+    evaluate_tasks, screen_nodes
+from bioiso import RESULTS_FORMATS, propagate_analysis, node_results, write_results_file, tree_arrays, ResultsArrays
 
 
 class BioISO:
 
-    def __init__(self, reaction_id, model, objective_direction, fast=False, time_out=900):
+    def __init__(self, reaction_id, model, objective_direction, fast=False, time_out=900, cache_path=None,
+                 cache_size=1000000, nodes_cache_size=None, shared_cache=None, watched_reactions=None, harvest=True,
+                 compress=False):
 
         self.levels = 0
 
@@ -25,7 +31,26 @@ class BioISO:
         # controlling cache
         # any time Bioiso starts the registry must be cleaned
         self.__id = self.reaction_id + '_' + self.model.id + '_' + self.objective_direction + '_' + str(id(self))
-        self.nodes_cache = NodeCache.new_node_cache(self.__id)
+        # the node cache keeps at most nodes_cache_size analysis (unbounded if None),
+        # and it is released once the instance is closed or garbage collected
+        # instances with the same shared_cache name share their analysis, which are keyed by the model state, so that
+        # runs on knockouts of watched_reactions reuse the analysis of the first run whenever its LPs still hold
+        # if harvest, the flux vector of each LP solved by simulate_reaction settles the reactions carrying flux in it,
+        # whose LPs are then skipped (see harvest_solution)
+        self.nodes_cache = NodeCache.new_node_cache(self.__id, max_size=nodes_cache_size, shared=shared_cache,
+                                                    watched=watched_reactions, harvest=harvest)
+        self.__finalizer = weakref.finalize(self, NodeCache.release, self.__id)
+
+        # optional on-disk store of the LP results, which are reused by any run on a model with the same content
+        self.cache_store = None
+        if cache_path is not None:
+            self.cache_store = NodeCacheStore(cache_path, max_size=cache_size)
+
+        # if compress, the LPs are solved in a reduced copy of the model without its blocked reactions and dead-end
+        # metabolites whenever it is exact for them, which is built at the start of each run unless it is a
+        # CompressedModel of the current model state (see run)
+        self.compress = compress
+        self.compressed = compress if isinstance(compress, CompressedModel) else None
 
         # controlling recursion timeout
         self.timeout = time_out
@@ -36,8 +61,77 @@ class BioISO:
         # also the node is set as leaf, and Bioiso doesn't go any further
         self.fast = fast
 
+        # all expands every node, whereas failures only expands the nodes whose analysis is False (see run)
+        self.strategy = 'all'
+
+        # number of worker processes used to evaluate the LPs of each level of the tree
+        self.workers = 1
+        self.__pool = None
+
+        # pool and solver engine provided by run_many, which are shared by its instances and kept between runs
+        self.__shared_resources = False
+
+        # cobra evaluates each node by adding and removing the drains of its metabolites (see simulate_reactants),
+        # whereas solver installs the drains up front and only toggles their bounds, solving every LP directly in the
+        # optlang problem (see SolverEngine)
+        self.engine = 'cobra'
+        self.__solver_engine = None
+
+        # stoichiometric matrix and bounds of the model, which are indexed at the start of each run (see run)
+        self.index = None
+
+        # network expansion of the model, which settles the nodes whose metabolite cannot be produced (or consumed)
+        # without solving their LPs, if the run is prefiltered (see run)
+        self.expansion = None
+
+        # whether the nodes of each reaction are screened in bulk before being evaluated one by one (see run)
+        self.screen = False
+
+        # nodes of the level being expanded (see populate_tree)
+        self.frontier = []
+
+        # nodes already built by subtree key, and the keys built in the current level (see build_node)
+        self.subtrees = {}
+        self.level_subtrees = set()
+
+        # results file and format to which the tree is streamed while populated depth-first, if any (see run),
+        # and whether the last run was streamed, as its tree is then not kept
+        self.output = None
+        self.streamed = False
+
+        # distinct metabolites and reactions of the tree, which are counted while populated (see stats)
+        self.search_space = SearchSpace()
+
         self.__principles_verified = False
 
+    def close(self):
+
+        """Releases the node cache of this instance and closes the on-disk store, if any"""
+
+        self.__finalizer()
+
+        if self.cache_store is not None:
+            self.cache_store.close()
+            self.cache_store = None
+
+    @property
+    def cache_stats(self):
+
+        """Hits, misses, inferred hits, harvested analysis and their hits (namely the LPs saved by harvesting),
+        prefiltered analysis (namely the LPs saved by the network expansion), analysis of reactions blocked in the
+        compressed model, analysis screened in bulk and the LPs of the screens, evictions and size of the node cache of
+        this instance"""
+
+        return self.nodes_cache.stats()
+
+    @property
+    def stats(self):
+
+        """Total and failing (bioiso) distinct reactions and metabolites of the tree, as given by searchSpaceSize and
+        bioisosearchSpaceSize for the results. Nodes are counted once complete, while the tree is populated"""
+
+        return self.search_space.stats()
+
     def changeTimeout(self, timeout_time):
         self.timeout = timeout_time
 
@@ -58,6 +152,36 @@ class BioISO:
                 print("Please try maximize or minimize as an {} object".format(str(str.__name__)))
                 raise e
 
+    def setStrategy(self, strategy):
+
+        if strategy in ('all', 'failures'):
+            self.strategy = strategy
+
+        else:
+            print("Oops! {} is not a valid strategy! Please try all or failures".format(str(strategy)))
+            raise ValueError
+
+    def setEngine(self, engine):
+
+        if engine in ('cobra', 'solver'):
+            self.engine = engine
+
+        else:
+            print("Oops! {} is not a valid engine! Please try cobra or solver".format(str(engine)))
+            raise ValueError
+
+    def setOutput(self, results_f_name, format='json'):
+
+        if format not in RESULTS_FORMATS:
+            print("Oops! {} is not a valid format! Please try json, ndjson or npz".format(str(format)))
+            raise ValueError
+
+        if results_f_name is None:
+            self.output = None
+
+        else:
+            self.output = (results_f_name, format)
+
     def __verify_reaction_principles(self):
 
         """Verifies the principles for testing the precursors of the input reaction
@@ -120,7 +244,7 @@ class BioISO:
         # testing first the root reaction
         if self.objective_direction == 'maximize':
 
-            reaction_flux = simulate_reaction(self.__id, self.model, reaction, True)
+            reaction_flux = simulate_reaction(self.__id, self.model, reaction, True, compressed=self.compressed)
 
             self.root.reactions_list = [(reaction, reaction.id, reaction_flux,
                                          list_reactants_ids(self.model, reaction.id),
@@ -130,7 +254,7 @@ class BioISO:
 
         else:
 
-            reaction_flux = simulate_reaction(self.__id, self.model, reaction, False)
+            reaction_flux = simulate_reaction(self.__id, self.model, reaction, False, compressed=self.compressed)
 
             self.root.reactions_list = [(reaction, reaction.id, reaction_flux,
                                          list_products_ids(self.model, reaction.id),
@@ -161,7 +285,10 @@ class BioISO:
                                                    self.model,
                                                    node.id,
                                                    isReactant=reactant,
-                                                   previous_reactions_list=last_reaction_list)
+                                                   previous_reactions_list=last_reaction_list,
+                                                   engine=self.__solver_engine,
+                                                   index=self.index,
+                                                   compressed=self.compressed)
 
             node.reactions_list, node.other_reactions_list = reactions
 
@@ -171,7 +298,10 @@ class BioISO:
                                               self.model,
                                               node.id,
                                               isReactant=reactant,
-                                              previous_reactions_list=last_reaction_list)
+                                              previous_reactions_list=last_reaction_list,
+                                              engine=self.__solver_engine,
+                                              index=self.index,
+                                              compressed=self.compressed)
 
             node.reactions_list, node.other_reactions_list = reactions
 
@@ -310,20 +440,196 @@ class BioISO:
                          is_reactant=is_reactant)
         next_node.previous = [previous_node]
         next_node.isLeaf = leaf
-        previous_reactions_list = previous_node.reactions_list
-        self.set_reactions_list_to_node(next_node, last_reaction_list=previous_reactions_list, reactant=is_reactant)
         previous_node.next.append(next_node)
 
         if is_reactant:
-            next_node.analysis = simulate_reactants(self.__id, self.model, next_node, reactants, products)
+            next_node.analysis = simulate_reactants(self.__id, self.model, next_node, reactants, products,
+                                                    engine=self.__solver_engine, expansion=self.expansion,
+                                                    compressed=self.compressed)
+        else:
+            next_node.analysis = simulate_products(self.__id, self.model, next_node, reactants, products,
+                                                   engine=self.__solver_engine, expansion=self.expansion,
+                                                   compressed=self.compressed)
+
+        if self.strategy == 'failures' and next_node.analysis and not leaf:
+            # successful nodes are neither evaluated nor expanded any further
+            next_node.pruned = True
+            next_node.isLeaf = True
+
+            return next_node
+
+        previous_reactions_list = previous_node.reactions_list
+
+        if self.subtrees is None:
+            # subtrees are not shared while streaming the tree (see stream_tree)
+            self.set_reactions_list_to_node(next_node, last_reaction_list=previous_reactions_list,
+                                            reactant=is_reactant)
+
+            return next_node
+
+        # the subtree of a node only depends on the node and on the previous reactions it takes part into,
+        # so a node already built with the same key shares its reactions.
+        # If it was built in this level, it shares its next nodes too
+        subtree_key = self.subtree_key(next_node, previous_reactions_list)
+        shared_node = self.subtrees.get(subtree_key)
+
+        if shared_node is None:
+
+            self.set_reactions_list_to_node(next_node, last_reaction_list=previous_reactions_list,
+                                            reactant=is_reactant)
+            self.subtrees[subtree_key] = next_node
+            self.level_subtrees.add(subtree_key)
+
+        elif subtree_key in self.level_subtrees:
+
+            next_node.reactions_list = shared_node.reactions_list
+            next_node.other_reactions_list = shared_node.other_reactions_list
+            next_node.next = shared_node.next
+            next_node.is_shared = True
+
         else:
-            next_node.analysis = simulate_products(self.__id, self.model, next_node, reactants, products)
+
+            next_node.reactions_list = shared_node.reactions_list
+            next_node.other_reactions_list = shared_node.other_reactions_list
+            self.subtrees[subtree_key] = next_node
+            self.level_subtrees.add(subtree_key)
 
         return next_node
 
-    def run(self, levels, fast=False):
+    def subtree_key(self, node, previous_reactions_list):
+
+        """Key of the subtree of a node, namely the node hash and the previous reactions that are excluded from the
+        node reactions_list (see set_reactions_list_to_node). Only the previous reactions where the metabolite takes
+        part into are considered, as the remaining do not change the subtree"""
+
+        previous_reactions_ids = {reaction[1] for reaction in previous_reactions_list}
+
+        excluded_reactions_ids = frozenset(reaction.id for reaction in self.index.get_reactions(node.id)
+                                           if reaction.id in previous_reactions_ids)
+
+        return node.get_hash(), excluded_reactions_ids
+
+    def run(self, levels, fast=False, workers=1, strategy='all', engine='cobra', results_f_name=None, format='json',
+            index=None, capabilities=None, prefilter=False, screen=False):
+
+        """Runs Bioiso up to the given number of levels
+        The failures strategy only expands the nodes whose analysis is False, and workers, engine ('cobra' or
+        'solver'), capabilities (see FluxCapabilities), prefilter (see NetworkExpansion) and screen (see
+        screen_frontier) only change how the LPs are solved, not the tree. If results_f_name is given, the tree is
+        written to this file while populated and it is not kept (see stream_tree)"""
+
+        self.setStrategy(strategy)
+        self.setEngine(engine)
+        self.setOutput(results_f_name, format)
 
         self.fast = fast
+        self.workers = workers
+        self.screen = screen
+
+        # the analysis are keyed by the current bounds of the model
+        NodeCache.set_state(self.__id, self.model)
+
+        # the roles of the reactions of each node are classified using the index of the current model
+        if index is None:
+            index = StoichiometricIndex(self.model)
+
+        self.index = index
+
+        if prefilter is True:
+            prefilter = NetworkExpansion(index)
+
+        self.expansion = prefilter if isinstance(prefilter, NetworkExpansion) else None
+
+        if self.compress and (self.compressed is None or not self.compressed.holds(self.model)):
+            self.compressed = CompressedModel(self.model)
+
+        if capabilities is True:
+            capabilities = FluxCapabilities(self.model)
+
+        if isinstance(capabilities, FluxCapabilities):
+            self.load_capabilities(capabilities)
+
+        if self.cache_store is None:
+            return self.__run(levels)
+
+        content_hash = model_hash(self.model)
+
+        NodeCache.load_store(self.__id, self.cache_store, content_hash)
+
+        try:
+            return self.__run(levels)
+
+        finally:
+            NodeCache.dump_store(self.__id, self.cache_store, content_hash)
+
+    def load_capabilities(self, capabilities):
+
+        """Adds the analysis of a FluxCapabilities table to the node cache, which must be a snapshot of the current
+        state of the model"""
+
+        if not capabilities.holds(self.model):
+            print("Oops! The flux capabilities are not a snapshot of the current model state")
+            raise ValueError
+
+        for composed_id, analysis in capabilities.items():
+            NodeCache.add_analysis(self.__id, composed_id, analysis)
+
+    @classmethod
+    def run_many(cls, model, targets, levels, fast=False, workers=1, strategy='all', engine='cobra',
+                 shared_cache=None, capabilities=None, prefilter=False, screen=False, **kwargs):
+
+        """Runs Bioiso for several (reaction_id, objective_direction) targets of the model (see run), sharing the node
+        cache, the index, the pool of workers and the solver engine, so that common precursors are only solved once.
+        The kwargs are passed to each instance. Return list of Bioiso instances, in the order of the targets"""
+
+        if shared_cache is None:
+            shared_cache = 'run_many_' + uuid.uuid4().hex
+
+        if kwargs.get('compress') is True:
+            kwargs['compress'] = CompressedModel(model)
+
+        instances = [cls(reaction_id, model, objective_direction, shared_cache=shared_cache, **kwargs)
+                     for reaction_id, objective_direction in targets]
+
+        if not instances:
+            return instances
+
+        index = StoichiometricIndex(model)
+
+        if capabilities is True:
+            capabilities = FluxCapabilities(model)
+
+        if prefilter is True:
+            prefilter = NetworkExpansion(index)
+
+        # the first instance opens the resources of every run
+        resources = instances[0]
+        resources.setEngine(engine)
+        resources.workers = workers
+        resources.open_resources()
+
+        try:
+
+            for instance in instances:
+                instance.__pool = resources.__pool
+                instance.__solver_engine = resources.__solver_engine
+                instance.__shared_resources = True
+
+                instance.run(levels, fast=fast, workers=workers, strategy=strategy, engine=engine, index=index,
+                             capabilities=capabilities, prefilter=prefilter, screen=screen)
+
+        finally:
+
+            resources.close_resources()
+
+            for instance in instances:
+                instance.__pool = None
+                instance.__solver_engine = None
+                instance.__shared_resources = False
+
+        return instances
+
+    def __run(self, levels):
 
         if not self.root:
             self.set_root()
@@ -331,6 +637,10 @@ class BioISO:
         if self.results is not None:
             self.results = None
 
+        self.streamed = False
+
+        self.search_space = SearchSpace()
+
         return self.populate_tree(levels)
 
     @timeout
@@ -344,71 +654,305 @@ class BioISO:
         self.levels = levels
 
         if self.levels < 0:
-            return
+
+            self.count_nodes([self.root])
 
         elif self.levels == 0:
 
             self.root.isLeaf = True
 
-        elif self.levels == 1:
+            if self.output is not None:
+                self.stream_tree()
 
-            self.create_next_nodes(self.root, leaf=True)
+            else:
+                self.count_nodes([self.root])
 
         else:
-            # if level is higher than 2
-            # a recursive function is called
 
-            self.__populate_tree([self.root], level=0)
+            self.__populate_tree()
 
-    def __populate_tree(self, nodes, level):
+    def __populate_tree(self):
 
-        """Recursive hidden method to populate the tree after the level 1
-        After level 1 this function is called with the next nodes of root, namely the first next nodes
-        for each node in the list of next nodes,
-        the recursive function goes deep until it reaches the maximum level (controlled by level == self.levels)
-        going through each level in a given node,
-        the recursive function creates the next_nodes of this node and then get these for next recursion
-        in the end, the final nodes are set as leafs
-        """
+        """Populates the tree breadth-first, one level at a time, unless it is streamed to a file (see stream_tree)
+        The frontier is the list of nodes of the current level, which are expanded together into the next frontier.
+        Before being expanded, the frontier is evaluated in a single batch (see evaluate_frontier).
+        The next nodes of the last level are set as leafs"""
 
-        if level == self.levels:
+        self.subtrees = {}
 
-            # exit for recursive function populate_sub_tree
+        if not self.__shared_resources:
+            self.open_resources()
 
-            # each next node in the last level is set as leaf
+        try:
 
-            for node in nodes:
-                node.isLeaf = True
+            if self.output is not None:
+                return self.stream_tree()
 
-            # finally, the recursion is ended
-            return
+            self.frontier = [self.root]
 
-        elif len(nodes) == 0:
+            # nodes of the level being expanded, including the shared and pruned ones, which are counted once their
+            # next nodes are created (see count_nodes)
+            level_nodes = [self.root]
 
-            # exit for recursive function populate_sub_tree
+            if self.strategy == 'failures' and self.root.analysis:
+                self.root.pruned = True
+                self.frontier = []
 
-            # each node without next node is set as leaf
+            for level in range(self.levels):
 
-            for node in nodes:
-                node.isLeaf = True
+                if not self.frontier:
+                    break
+
+                self.evaluate_frontier(self.frontier, leaf=level + 1 == self.levels)
+
+                self.frontier = self.expand_frontier(self.frontier, leaf=level + 1 == self.levels)
+
+                level_nodes = self.count_nodes(level_nodes)
+
+            self.count_nodes(level_nodes)
+
+        finally:
+
+            if not self.__shared_resources:
+                self.close_resources()
+
+    def open_resources(self):
+
+        """Creates the pool of workers and the solver engine required by the workers and engine of the run"""
+
+        self.__pool = None
+        self.__solver_engine = None
+
+        if self.workers > 1:
+            self.__pool = new_pool(self.model, self.workers, self.engine, self.compressed)
+
+        if self.engine == 'solver':
+            self.__solver_engine = SolverEngine(self.model)
+
+            if self.compressed is not None:
+                self.compressed.engine = SolverEngine(self.compressed.model)
+
+    def close_resources(self):
+
+        """Terminates the pool of workers and removes the drains of the solver engine from the model, if any"""
+
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool = None
+
+        if self.__solver_engine is not None:
+            self.__solver_engine.remove()
+            self.__solver_engine = None
+
+        if self.compressed is not None and self.compressed.engine is not None:
+            self.compressed.engine.remove()
+            self.compressed.engine = None
+
+    def stream_tree(self):
+
+        """Populates the tree depth-first while writing it to the results file (see write_results)
+        Each node is expanded right before being written, as its analysis depends on the analysis of its next nodes,
+        and its next nodes are released once it is written (see bioiso.utils.resultsUtils.write_tree).
+        Thus, only the nodes of the current path and their next nodes are kept.
+        Subtrees are not shared (see build_node), as the shared nodes would keep the whole tree alive.
+        The results are the same of populate_tree and write_results"""
+
+        self.subtrees = None
+        self.streamed = True
+
+        if self.strategy == 'failures' and self.root.analysis:
+            self.root.pruned = True
+
+        results_f_name, format = self.output
+
+        write_results_file(results_f_name, [self.root], format=format, expand=self.expand_node)
+
+    def expand_node(self, node, depth):
+
+        """Creates the next nodes of a node at the given depth of the tree, unless it is a leaf or it was pruned"""
+
+        if depth < self.levels and not node.pruned:
+
+            leaf = depth + 1 == self.levels
+
+            self.evaluate_frontier([node], leaf=leaf)
+
+            self.create_next_nodes(node, leaf=leaf)
+
+        self.count_nodes([node])
+
+    def count_nodes(self, nodes):
+
+        """Adds complete nodes, namely nodes whose next nodes were already created, to the search space (see stats)
+        Return the next nodes of the given nodes, each list of next nodes being listed once, as shared nodes share the
+        next nodes"""
+
+        next_nodes = []
+        next_lists = set()
+
+        for node in nodes:
+
+            self.search_space.add(node.id, propagate_analysis(node),
+                                  ((reaction[1], reaction[2]) for reaction in node.reactions_list))
+
+            if id(node.next) not in next_lists:
+                next_lists.add(id(node.next))
+                next_nodes.extend(node.next)
+
+        return next_nodes
+
+    def expand_frontier(self, nodes, leaf=False):
+
+        """Creates the next nodes of each node in the frontier
+        Return the next frontier, namely the next nodes of the given nodes in order"""
+
+        # next nodes are only shared within the same level, as the subtrees of the next level are one level shallower
+        self.level_subtrees = set()
+
+        next_frontier = []
+
+        for node in nodes:
+            self.create_next_nodes(node, leaf=leaf)
+
+            # nodes sharing the subtree of another node and pruned nodes are not expanded
+            next_frontier.extend(next_node for next_node in node.get_next()
+                                 if not next_node.is_shared and not next_node.pruned)
+
+        return next_frontier
 
-            # finally, the recursion is ended
+    def evaluate_frontier(self, nodes, leaf=False):
+
+        """Solves in a single batch every LP required to expand the frontier that is not already in the node cache
+        The LPs are dispatched to the pool of workers, if any.
+        Otherwise, they are solved while expanding the frontier"""
+
+        if self.screen:
+            self.screen_frontier(nodes, leaf)
+
+        if self.__pool is None:
             return
 
-        else:
+        # with the failures strategy, the reactions of the next nodes are only planned once their analysis is known,
+        # so the frontier is planned until there is nothing left to solve
+        tasks = self.plan_frontier(nodes, leaf)
+
+        while tasks:
+
+            composed_ids = list(tasks.keys())
+
+            results = evaluate_tasks(self.__pool, list(tasks.values()), self.workers)
+
+            for composed_id, analysis in zip(composed_ids, results):
+                NodeCache.add_analysis(self.__id, composed_id, analysis)
+
+            tasks = self.plan_frontier(nodes, leaf)
+
+    def screen_frontier(self, nodes, leaf=False):
+
+        """Screens in bulk the nodes of the frontier that are not in the node cache yet
+        The LPs of the nodes of a reaction only differ in the objective, so the nodes of each reaction are screened
+        together (see bioiso.wrappers.capabilityWrapper.screen_nodes), and only the ones left are evaluated by their
+        own LPs"""
+
+        reactions_nodes = {}
+
+        for composed_id in self.plan_frontier(nodes, leaf):
+
+            name = composed_id[0]
+
+            if name == 'simulate_reaction':
+                continue
+
+            reactions_nodes.setdefault(composed_id[2:], []).append((composed_id[1], name == 'simulate_reactants'))
+
+        for (reactants_ids, products_ids), reaction_nodes in reactions_nodes.items():
+
+            # a single node is evaluated by its own LP, which is as costly as the screen
+            if len(reaction_nodes) > 1:
+                screen_nodes(self.__id, self.model, reactants_ids, products_ids, reaction_nodes,
+                             engine=self.__solver_engine, compressed=self.compressed)
+
+    def plan_frontier(self, nodes, leaf=False):
+
+        """Lists the LPs that create_next_nodes will solve for the given nodes, without solving them
+        It mirrors create_next_nodes, create_next_nodes_by_reaction, build_node and set_reactions_list_to_node
+        Return dict of composed id: task (see bioiso.wrappers.parallelWrapper.evaluate_task)"""
+
+        tasks = {}
+
+        def add_task(name, args, task):
+
+            composed_id = NodeCache.create_composed_ids(name, args)
+
+            if composed_id not in tasks and not NodeCache.has_analysis(self.__id, composed_id):
+                tasks[composed_id] = task
 
-            # if the recursive function has not reached the maximum level
+            return composed_id
 
-            # iteration over the next nodes of the root and following next nodes of these
-            for node in nodes:
-                self.create_next_nodes(node)
+        for node in nodes:
 
-                nodes = node.get_next()
+            if self.fast and len(node.reactions_list) >= 20:
+                continue
 
-                self.__populate_tree(nodes, level + 1)
+            next_nodes_hashes = set()
+
+            for reaction in node.reactions_list:
+
+                reactants = reaction[5]
+                products = reaction[6]
+
+                for is_reactant, metabolites in ((True, reactants), (False, products)):
+
+                    for metabolite in metabolites:
+
+                        next_node = Node(identifier=metabolite.id,
+                                         name=metabolite.name,
+                                         compartment=metabolite.compartment,
+                                         is_reactant=is_reactant)
+
+                        if next_node.get_hash() in next_nodes_hashes:
+                            continue
+
+                        next_nodes_hashes.add(next_node.get_hash())
+
+                        name = 'simulate_reactants' if is_reactant else 'simulate_products'
+
+                        # the nodes settled by the network expansion are cached here, so they are not dispatched
+                        if self.expansion is not None and self.expansion.blocks(next_node, reactants, products):
+                            simulate = simulate_reactants if is_reactant else simulate_products
+                            simulate(self.__id, self.model, next_node, reactants, products, expansion=self.expansion)
+
+                        composed_id = add_task(name,
+                                               (self.model, next_node, reactants, products),
+                                               (name,
+                                                metabolite.id,
+                                                [reactant.id for reactant in reactants],
+                                                [product.id for product in products]))
+
+                        if self.strategy == 'failures' and not leaf:
+
+                            # pruned nodes are not evaluated (see build_node)
+                            if NodeCache.get_analysis(self.__id, composed_id) is not False:
+                                continue
+
+                        to_simulate = list_reactions_to_simulate(self.model,
+                                                                 metabolite.id,
+                                                                 isReactant=is_reactant,
+                                                                 previous_reactions_list=node.reactions_list,
+                                                                 fast=self.fast,
+                                                                 index=self.index)
+
+                        for next_reaction, maximize in to_simulate:
+                            add_task('simulate_reaction',
+                                     (self.model, next_reaction, maximize),
+                                     ('simulate_reaction', next_reaction.id, maximize))
+
+        return tasks
 
     def get_tree(self):
 
+        self.__verify_tree()
+
         if self.results:
             return self.results
 
@@ -427,57 +971,54 @@ class BioISO:
         # build a subtree for each child
         for child in nodes:
 
-            _id = child.id
-            _name = child.name
-            _compartment = child.compartment
-            _analysis = child.analysis
-            _role = evaluate_side(child.is_reactant)
-            _reactions_list = [(rxn[1], rxn[2], rxn[3], rxn[4])
-                               for rxn in child.reactions_list]
-            _other_reactions_list = [(rxn[1], rxn[2], rxn[3], rxn[4])
-                                     for rxn in child.other_reactions_list]
+            # start new subtree
+            subtree = node_results(child)
+            subtree['next'] = {}
+
+            tree[child.get_hash(stringify=True)] = subtree
 
-            if _analysis:
+            # call recursively to build a subtree for current node
+            self.__get_tree(subtree['next'], child.get_next())
 
-                if child.has_next_nodes():
+    def write_results(self, results_f_name, format='json'):
 
-                    false_children = [next_child for next_child in child.get_next()
-                                      if not next_child.analysis]
+        """Writes the results to a file, either as the JSON of get_tree ('json'), as one JSON object per node and
+        line ('ndjson') or as compressed NumPy arrays ('npz'), which are smaller and faster to load
+        (see bioiso.utils.resultsUtils.load_results). The results are streamed from the tree, so get_tree is not
+        called and self.results is not filled"""
 
-                    if len(false_children) > 0:
-                        _analysis = False
+        self.__verify_tree()
 
-            if not _analysis:
+        if format not in RESULTS_FORMATS:
+            print("Oops! {} is not a valid format! Please try json, ndjson or npz".format(str(format)))
+            raise ValueError
 
-                true_rxns = [rxn[0] for rxn in _reactions_list if rxn[1]]
+        write_results_file(results_f_name, [self.root], format=format)
 
-                if len(true_rxns) > 0:
-                    _analysis = True
+    def to_frame(self):
 
-                if child.has_next_nodes() and not _analysis:
+        """Flat tables of the results, namely the nodes DataFrame and the reactions DataFrame of the reactions of each
+        node, the next nodes being linked to their parent by parent_id (see bioiso.utils.resultsUtils.ResultsArrays)"""
 
-                    true_children = [next_child for next_child in child.get_next()
-                                     if next_child.analysis]
+        self.__verify_tree()
 
-                    if len(true_children) == len(child.get_next()):
-                        _analysis = True
+        return ResultsArrays(tree_arrays([self.root])).to_frames()
 
-            # start new subtree
-            tree[child.get_hash(stringify=True)] = {'identifier': _id,
-                                                    'name': _name,
-                                                    'compartment': _compartment,
-                                                    'analysis': _analysis,
-                                                    'role': _role,
-                                                    'reactions': _reactions_list,
-                                                    'other_reactions': _other_reactions_list,
-                                                    'next': {}}
+    def __verify_tree(self):
 
-            # call recursively to build a subtree for current node
-            self.__get_tree(tree[child.get_hash(stringify=True)]['next'], child.get_next())
+        """The tree of a streamed run is not kept, so its results can only be read from the results file"""
+
+        if self.streamed:
+            print("Oops! The tree was streamed to {} and it was not kept! Please read it with load_results".format(
+                str(self.output[0])))
+            raise ValueError
+
+    def write_frames(self, nodes_f_name, reactions_f_name):
 
-    def write_results(self, results_f_name):
+        """Writes the nodes and reactions DataFrames of the results (see to_frame) to Parquet files, which requires
+        pyarrow or fastparquet"""
 
-        results = self.get_tree()
+        nodes, reactions = self.to_frame()
 
-        with open(results_f_name, "w") as jsonfile:
-            json.dump(results, jsonfile)
+        nodes.to_parquet(nodes_f_name, index=False)
+        reactions.to_parquet(reactions_f_name, index=False)
@@ -0,0 +1,181 @@
+import json
+import multiprocessing
+import os
+import time
+import uuid
+
+from bioiso import propagate_analysis
+from bioiso.core.bioiso import BioISO
+
+# model and arguments of the scan, which forked worker processes inherit copy-on-write
+_scan_model = None
+_scan_args = None
+
+
+def scan_index_name(results_path, model, reaction_id, objective_direction):
+    """Index of a scan, namely the NDJSON file with one record per KO completed"""
+
+    return os.path.join(results_path, '{}_{}_{}_scan.ndjson'.format(model.id, reaction_id, objective_direction))
+
+
+def scan_params(levels, fast, strategy, engine, format):
+    """Parameters of a scan that change its records, which are stored in each record of the index"""
+
+    return {'levels': levels, 'fast': fast, 'strategy': strategy, 'engine': engine, 'format': format}
+
+
+def read_scan_index(index_name, params):
+    """Records of the KOs completed in a previous scan with the same parameters, by KO"""
+
+    records = {}
+
+    if not os.path.exists(index_name):
+        return records
+
+    with open(index_name) as file:
+
+        for line in file:
+
+            # the last line might be incomplete if the scan was interrupted while writing it
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+
+            if record.get('params') == params:
+                records[record['ko']] = record
+
+    return records
+
+
+def run_knockout(ko):
+    """Runs Bioiso for the target of the scan in the scan model with the bounds of the KO reaction set to zero
+    Return the record of the KO, namely the KO, the parameters of the scan (see scan_params), the running time, the
+    analysis of the root, the search space (see BioISO.stats), the node cache stats and the results file, if any.
+    Errors are recorded instead of raised"""
+
+    model = _scan_model
+    reaction_id, objective_direction, params, bioiso_kwargs, results_path = _scan_args
+
+    levels = params['levels']
+    run_kwargs = {'fast': params['fast'], 'strategy': params['strategy'], 'engine': params['engine']}
+    format = params['format']
+
+    record = {'ko': ko, 'params': params}
+
+    t0 = time.time()
+
+    try:
+
+        with model as m:
+            m.reactions.get_by_id(ko).bounds = (0.0, 0.0)
+
+            bio = BioISO(reaction_id, m, objective_direction, **bioiso_kwargs)
+            bio.run(levels, **run_kwargs)
+
+        record['time'] = float(time.time() - t0)
+        record['analysis'] = propagate_analysis(bio.root)
+        record.update(bio.stats)
+        record['cache'] = bio.cache_stats
+
+        if results_path is not None:
+            # the results of scans with other parameters are kept
+            results_f_name = os.path.join(results_path, '{}_{}_{}_{}_{}_{}{}.{}'.format(
+                model.id, ko, reaction_id, objective_direction, levels, params['strategy'],
+                '_fast' if params['fast'] else '', format))
+            bio.write_results(results_f_name, format=format)
+            record['results'] = results_f_name
+
+        bio.close()
+
+    except Exception as e:
+        record['time'] = float(time.time() - t0)
+        record['error'] = repr(e)
+
+    return record
+
+
+def scan_knockouts(model, reaction_id, objective_direction, kos, levels, workers=1, fast=False, strategy='all',
+                   engine='cobra', results_path=None, format='json', warm_cache=True, **kwargs):
+    """Runs Bioiso for a target reaction in each single reaction KO of the model, yielding the record of each KO as
+    soon as it is completed (see run_knockout). If warm_cache, the KO runs reuse the analysis of a run without KOs.
+    If results_path is given, KOs already in the index of the scan with the same parameters (see scan_params) are
+    not run again, so that an interrupted scan can be resumed"""
+
+    global _scan_model, _scan_args
+
+    kos = list(dict.fromkeys(kos))
+
+    params = scan_params(levels, fast, strategy, engine, format)
+
+    index_name = None
+    completed = {}
+
+    if results_path is not None:
+
+        if not os.path.exists(results_path):
+            os.makedirs(results_path)
+
+        index_name = scan_index_name(results_path, model, reaction_id, objective_direction)
+        completed = read_scan_index(index_name, params)
+
+    for ko in kos:
+
+        if ko in completed:
+            yield completed[ko]
+
+    pending = [ko for ko in kos if ko not in completed]
+
+    if not pending:
+        return
+
+    bioiso_kwargs = dict(kwargs)
+
+    base = None
+    pool = None
+    index_file = None
+
+    try:
+
+        if warm_cache:
+            # the base run fills the storage shared by the KO runs, which forked workers inherit
+            bioiso_kwargs['shared_cache'] = bioiso_kwargs.get('shared_cache') or 'scan_' + uuid.uuid4().hex
+            bioiso_kwargs['watched_reactions'] = pending
+
+            base = BioISO(reaction_id, model, objective_direction, **bioiso_kwargs)
+            base.run(levels, fast=fast, strategy=strategy, engine=engine)
+
+        _scan_model = model
+        _scan_args = (reaction_id, objective_direction, params, bioiso_kwargs, results_path)
+
+        if index_name is not None:
+            index_file = open(index_name, 'a')
+
+        if workers > 1:
+            pool = multiprocessing.get_context('fork').Pool(processes=workers)
+            records = pool.imap_unordered(run_knockout, pending)
+
+        else:
+            records = map(run_knockout, pending)
+
+        for record in records:
+
+            if index_file is not None and 'error' not in record:
+                index_file.write(json.dumps(record) + '\n')
+                index_file.flush()
+
+            yield record
+
+    finally:
+
+        if pool is not None:
+            pool.terminate()
+
+        if index_file is not None:
+            index_file.close()
+
+        if base is not None:
+            base.close()
+
+        _scan_model = None
+        _scan_args = None
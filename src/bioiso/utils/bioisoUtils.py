@@ -1,10 +1,18 @@
 import cobra
 import time
+import sqlite3
 from threading import Thread
 import functools
+import hashlib
+import weakref
+from collections import OrderedDict
 
 
 class Node:
+    # a tree may have millions of nodes, so they do not have a __dict__
+    __slots__ = ('id', 'name', 'compartment', 'is_reactant', 'reactions_list', 'other_reactions_list', 'next',
+                 'previous', 'analysis', 'isLeaf', 'is_shared', 'pruned', '_next_list', '_next_indexes',
+                 '_next_indexed')
 
     def __init__(self, identifier=None, name=None, compartment=None, is_reactant=True):
         self.id = identifier
@@ -17,6 +25,15 @@ class Node:
         self.previous = []
         self.analysis = None
         self.isLeaf = False
+        # the reactions and next nodes are shared with another node of the same level having the same subtree
+        self.is_shared = False
+        # successful node that was not expanded (see BioISO.run with the failures strategy)
+        self.pruned = False
+
+        # indexes of the next nodes by hash, id or name (see get_next_index)
+        self._next_list = None
+        self._next_indexes = None
+        self._next_indexed = 0
 
     def get_hash(self, stringify=False):
 
@@ -38,47 +55,439 @@ class Node:
     def has_next_nodes(self):
         return len(self.get_next()) > 0
 
-    def has_next_by_hash(self, hash_tuple):
+    def get_next_index(self, key):
 
-        next_nodes = self.get_next()
+        """Dictionary of the next nodes by hash, id or name, keeping the first node of each key as the linear scan did.
+        The indexes are only created when used, and they are kept up to date with the next list, which might be
+        appended or replaced (e.g. when shared with another node)"""
 
-        for node in next_nodes:
+        if self._next_list is not self.next:
+            self._next_list = self.next
+            self._next_indexes = {}
+            self._next_indexed = 0
 
-            if node.get_hash() == hash_tuple:
-                return node
+        if key not in self._next_indexes:
+            index = {}
 
-        return
+            for node in self.next[:self._next_indexed]:
+                index.setdefault(node.get_next_key(key), node)
 
-    def has_next(self, identifier):
+            self._next_indexes[key] = index
+
+        if self._next_indexed < len(self.next):
+
+            for node in self.next[self._next_indexed:]:
+
+                for next_key, index in self._next_indexes.items():
+                    index.setdefault(node.get_next_key(next_key), node)
+
+            self._next_indexed = len(self.next)
 
-        next_nodes = self.get_next()
+        return self._next_indexes[key]
 
-        for node in next_nodes:
+    def get_next_key(self, key):
 
-            if node.id == identifier:
-                return node
+        if key == 'hash':
+            return self.get_hash()
 
-        return
+        if key == 'id':
+            return self.id
+
+        return self.name
+
+    def has_next_by_hash(self, hash_tuple):
+        return self.get_next_index('hash').get(hash_tuple)
+
+    def has_next(self, identifier):
+        return self.get_next_index('id').get(identifier)
 
     def has_next_by_name(self, name):
+        return self.get_next_index('name').get(name)
+
+
+# witness of an infeasible LP (see NodeRegistry)
+INFEASIBLE = 'infeasible'
+
+
+class BoundsFingerprint:
+    """Fingerprint of the state of a model, namely its structure, the direction of its objective and the bounds of its
+    reactions. The structure (reactions and stoichiometry) is hashed once, while the bounds digest is the xor of the
+    hash of (reaction id, lower bound, upper bound) of every reaction, so a bound change only updates the term of the
+    reaction. The objective reaction is not part of the state, as every LP of Bioiso sets its own objective, but the
+    maximize LPs are solved in the objective direction.
+    The state is the tuple (structure hash, objective direction, bounds digest)"""
+
+    def __init__(self, model):
+
+        structure = hashlib.sha1()
+
+        for reaction in sorted(model.reactions, key=lambda x: x.id):
+            structure.update(repr((reaction.id, sorted((metabolite.id, coefficient)
+                                                       for metabolite, coefficient in reaction.metabolites.items())))
+                             .encode())
+
+        self.structure = structure.hexdigest()
+        self.direction = None
+
+        self.bounds = {}
+        self.digest = 0
+
+        self.refresh(model)
+
+    def update(self, reaction_id, bounds):
+
+        """Updates the fingerprint with the new bounds of a reaction"""
+
+        bounds = (float(bounds[0]), float(bounds[1]))
+
+        if reaction_id in self.bounds:
+            self.digest ^= hash((reaction_id,) + self.bounds[reaction_id])
+
+        self.bounds[reaction_id] = bounds
+        self.digest ^= hash((reaction_id,) + bounds)
+
+    def refresh(self, model):
+
+        """Updates the fingerprint with the current bounds and objective direction of the model, only the changed
+        reactions being rehashed"""
+
+        self.direction = model.solver.objective.direction
+
+        for reaction in model.reactions:
+
+            bounds = (float(reaction.lower_bound), float(reaction.upper_bound))
+
+            if self.bounds.get(reaction.id) != bounds:
+                self.update(reaction.id, bounds)
+
+        return self.state
+
+    @property
+    def state(self):
+        return self.structure, self.direction, self.digest
+
+
+class NodeStorage:
+    """Analysis cached by NodeCache, keyed by (composed id, model state), which may be shared by several Bioiso
+    instances. It keeps at most max_size analysis (None for unbounded), evicting the least recently used ones.
+    Each analysis comes with a witness, so that the analysis of the base state, namely the first state registered,
+    can be reused by states that only tighten its bounds (see NodeRegistry.infer)"""
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.analysis = OrderedDict()
+        self.evictions = 0
+
+        # keys of the harvested analysis not used yet (see add_spare)
+        self.harvested = set()
+
+        self.base_state = None
+        self.base_bounds = None
+        self.watched = set()
+
+    def add(self, key, analysis, witness=None):
+
+        self.analysis[key] = (analysis, witness)
+        self.analysis.move_to_end(key)
+        self.harvested.discard(key)
+
+        if self.max_size is not None and len(self.analysis) > self.max_size:
+            evicted, _ = self.analysis.popitem(last=False)
+            self.harvested.discard(evicted)
+            self.evictions += 1
+
+    def add_spare(self, key, analysis, witness=None):
+
+        """Adds a harvested analysis only if the key is new and the storage has room for it, so it never evicts"""
+
+        if key in self.analysis or (self.max_size is not None and len(self.analysis) >= self.max_size):
+            return False
+
+        self.analysis[key] = (analysis, witness)
+        self.harvested.add(key)
+
+        return True
+
+
+class NodeRegistry:
+    """Node cache of a Bioiso instance
+    It looks up the analysis of the current model state in the (possibly shared) storage, and counts hits, misses and
+    inferred hits (analysis reused from the base state). Analysis loaded from a NodeCacheStore are kept apart,
+    by the repr of the composed id, and are only moved to the storage once they are used"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.fingerprint = None
+        self.state = None
+        self.changes = {}
+        self.tightens_base = False
+        self.stored_analysis = {}
+
+        # witness of the last LP solved (see bioiso.wrappers.cobraWrapper.record_witness)
+        self.witness = None
+
+        # whether the analysis proved by each LP solution are harvested, the reactions read from the solutions
+        # (see bioiso.wrappers.cobraWrapper.harvest_solution)
+        self.harvest = False
+        self.harvest_reactions = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.inferred = 0
+        self.harvested_count = 0
+        self.harvest_hits = 0
+
+        # analysis settled by the NetworkExpansion, without solving their LPs (see record_prefiltered)
+        self.prefiltered = 0
+
+        # analysis of reactions blocked in a CompressedModel, without solving their LPs (see record_blocked)
+        self.blocked = 0
+
+        # analysis settled by bulk screens and the LPs they solved (see bioiso.wrappers.capabilityWrapper.screen_nodes)
+        self.screened = 0
+        self.screen_lps = 0
+
+    def set_state(self, model):
+
+        """Updates the model state, which is part of every key. It must be called whenever the model bounds or the
+        objective direction change"""
+
+        if self.fingerprint is None:
+            self.fingerprint = BoundsFingerprint(model)
+
+        self.state = self.fingerprint.refresh(model)
+        self.harvest_reactions = {}
+
+        storage = self.storage
+
+        if storage.base_state is None:
+            storage.base_state = self.state
+            storage.base_bounds = dict(self.fingerprint.bounds)
+
+        # bounds that differ from the base state
+        self.changes = {}
+        self.tightens_base = storage.base_state[:2] == self.state[:2]
+
+        if self.tightens_base:
+
+            for reaction_id, bounds in self.fingerprint.bounds.items():
+
+                base_bounds = storage.base_bounds.get(reaction_id)
+
+                if base_bounds != bounds:
+                    self.changes[reaction_id] = bounds
+
+                    if base_bounds is None or bounds[0] < base_bounds[0] or bounds[1] > base_bounds[1]:
+                        self.tightens_base = False
+
+    def lookup(self, composed_id):
+
+        """Analysis of the call in the current state, or None"""
+
+        entry = self.storage.analysis.get((composed_id, self.state))
+
+        if entry is not None:
+            return entry[0]
+
+        if self.stored_analysis:
+
+            analysis = self.stored_analysis.pop(repr(composed_id), None)
+
+            if analysis is not None:
+                self.storage.add((composed_id, self.state), analysis)
+                return analysis
+
+        return self.infer(composed_id)
+
+    def infer(self, composed_id, tol=1E-09):
+
+        """Reuses the analysis of the base state if the current state only tightens the bounds of watched reactions
+        and the LP solution of the base state is still feasible, as the LP optimum is then the same.
+        An infeasible LP remains infeasible when bounds are tightened"""
+
+        if not self.tightens_base or self.state == self.storage.base_state:
+            return
+
+        entry = self.storage.analysis.get((composed_id, self.storage.base_state))
+
+        if entry is None:
+            return
+
+        analysis, witness = entry
+
+        if witness is None:
+            return
+
+        if witness != INFEASIBLE:
+
+            for reaction_id, (lower_bound, upper_bound) in self.changes.items():
+
+                if reaction_id not in witness:
+                    return
+
+                if not lower_bound - tol <= witness[reaction_id] <= upper_bound + tol:
+                    return
+
+        self.storage.add((composed_id, self.state), analysis)
+        self.inferred += 1
+
+        return analysis
+
+    def __contains__(self, composed_id):
+        return self.lookup(composed_id) is not None
+
+    def __len__(self):
+        return len(self.storage.analysis)
+
+    def get(self, composed_id):
+
+        analysis = self.lookup(composed_id)
+
+        if analysis is None:
+            self.misses += 1
+            return
+
+        key = (composed_id, self.state)
 
-        next_nodes = self.get_next()
+        self.hits += 1
+        self.storage.analysis.move_to_end(key)
 
-        for node in next_nodes:
+        # a harvested analysis saves an LP the first time it is used
+        if key in self.storage.harvested:
+            self.storage.harvested.discard(key)
+            self.harvest_hits += 1
 
-            if node.name == name:
-                return node
+        return analysis
 
-        return
+    def add(self, composed_id, analysis, witness=None):
+        self.storage.add((composed_id, self.state), analysis, witness)
+
+    def add_harvested(self, composed_ids, analysis, witness=None):
+
+        """Adds the analysis proved by an LP solution to the calls that are not in the storage yet, while it has room"""
+
+        for composed_id in composed_ids:
+
+            if self.storage.add_spare((composed_id, self.state), analysis, witness):
+                self.harvested_count += 1
+
+    def add_screened(self, composed_ids, analysis, witness=None):
+
+        """Adds the analysis settled by a bulk screen to the calls that are not in the storage yet"""
+
+        for composed_id in composed_ids:
+
+            key = (composed_id, self.state)
+
+            if key not in self.storage.analysis:
+                self.storage.add(key, analysis, witness)
+                self.screened += 1
+
+    def items(self):
+
+        """Composed ids and analysis of the current state"""
+
+        for (composed_id, state), (analysis, witness) in self.storage.analysis.items():
+
+            if state == self.state:
+                yield composed_id, analysis
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'inferred': self.inferred,
+                'harvested': self.harvested_count,
+                'harvest hits': self.harvest_hits,
+                'prefiltered': self.prefiltered,
+                'blocked': self.blocked,
+                'screened': self.screened,
+                'screen lps': self.screen_lps,
+                'evictions': self.storage.evictions,
+                'size': len(self.storage.analysis)}
 
 
 class NodeCache:
     bioiso_instances = {}
 
+    # storages shared by name, which are released once no Bioiso instance uses them
+    shared_storages = weakref.WeakValueDictionary()
+
+    @classmethod
+    def new_node_cache(cls, instance, max_size=None, shared=None, watched=None, harvest=False):
+
+        """Creates the node cache of a Bioiso instance.
+        Instances created with the same shared name share their storage (and max_size is the one of the first),
+        while the reactions in watched are the ones whose flux is recorded as witness of each LP.
+        If harvest, the analysis proved by the flux vector of each LP solution are added as well"""
+
+        if shared is None:
+            storage = NodeStorage(max_size)
+
+        else:
+            storage = cls.shared_storages.get(shared)
+
+            if storage is None:
+                storage = NodeStorage(max_size)
+                cls.shared_storages[shared] = storage
+
+        if watched is not None:
+            storage.watched.update(watched)
+
+        cls.bioiso_instances[instance] = NodeRegistry(storage)
+        cls.bioiso_instances[instance].harvest = harvest
+
+        return cls.bioiso_instances[instance]
+
     @classmethod
-    def new_node_cache(cls, instance):
-        cls.bioiso_instances[instance] = {}
-        return cls.bioiso_instances
+    def release(cls, instance):
+        """Removes the node cache of a Bioiso instance"""
+
+        cls.bioiso_instances.pop(instance, None)
+
+    @classmethod
+    def stats(cls, instance):
+
+        if instance in cls.bioiso_instances:
+            return cls.bioiso_instances[instance].stats()
+
+    @classmethod
+    def set_state(cls, instance, model):
+
+        if instance in cls.bioiso_instances:
+            cls.bioiso_instances[instance].set_state(model)
+
+    @classmethod
+    def has_analysis(cls, instance, composed_id):
+        return instance in cls.bioiso_instances and composed_id in cls.bioiso_instances[instance]
+
+    @classmethod
+    def get_analysis(cls, instance, composed_id):
+
+        if instance in cls.bioiso_instances:
+            return cls.bioiso_instances[instance].lookup(composed_id)
+
+    @classmethod
+    def add_analysis(cls, instance, composed_id, analysis, witness=None):
+        """Registers an analysis computed elsewhere (e.g. by a worker process) in the node cache of a Bioiso instance"""
+
+        if instance in cls.bioiso_instances:
+            cls.bioiso_instances[instance].add(composed_id, analysis, witness)
+
+    @classmethod
+    def load_store(cls, instance, store, model_hash):
+        """Makes every analysis of the model available in the store visible to the node cache of a Bioiso instance"""
+
+        if instance in cls.bioiso_instances:
+            cls.bioiso_instances[instance].stored_analysis = store.load(model_hash)
+
+    @classmethod
+    def dump_store(cls, instance, store, model_hash):
+        """Writes the node cache of a Bioiso instance to the store"""
+
+        if instance in cls.bioiso_instances:
+            registry = cls.bioiso_instances[instance]
+
+            store.dump(model_hash, {repr(composed_id): analysis for composed_id, analysis in registry.items()})
 
     def __init__(self, func):
         self.function = func
@@ -86,51 +495,108 @@ class NodeCache:
 
     def __call__(self, *args, **kwargs):
 
-        bioiso_instance = args[0]
+        node_registry = self.bioiso_instances.get(args[0])
 
-        if bioiso_instance not in self.bioiso_instances:
-            analysis = self.function(*args, **kwargs)
-            return analysis
+        if node_registry is None:
+            return self.function(*args, **kwargs)
 
-        else:
+        composed_id = self.create_composed_ids(self._name, args[1:])
 
-            composed_id = self.create_composed_ids(self._name, args[1:])
+        analysis = node_registry.get(composed_id)
 
-            node_registry = self.bioiso_instances[bioiso_instance]
-
-            if composed_id in node_registry:
-                return node_registry[composed_id]
+        if analysis is None:
+            node_registry.witness = None
+            analysis = self.function(*args, **kwargs)
+            node_registry.add(composed_id, analysis, node_registry.witness)
 
-            else:
-                analysis = self.function(*args, **kwargs)
-                node_registry[composed_id] = analysis
-                return analysis
+        return analysis
 
     @staticmethod
     def create_composed_ids(name, args):
 
-        composed_id = '' + str(name)
+        """Hashable key of a call, namely a tuple with the function name and the identifiers of the arguments.
+        Lists of metabolites are keyed by the tuple of their identifiers, while tuples (of identifiers) are used as is.
+        Models are not part of the key, as the node registry keys every call by the model state"""
 
-        for arg in args:
+        composed_id = [name]
 
-            if isinstance(arg, cobra.core.model.Model):
-                composed_id = composed_id + str(arg.name)
+        for arg in args:
 
             if isinstance(arg, cobra.core.reaction.Reaction):
-                composed_id = composed_id + str(arg.id)
+                composed_id.append(arg.id)
+
+            elif isinstance(arg, Node):
+                composed_id.append(arg.id)
+
+            elif isinstance(arg, bool):
+                composed_id.append(arg)
+
+            elif isinstance(arg, list):
+                composed_id.append(tuple(met.id for met in arg))
+
+            elif isinstance(arg, tuple):
+                composed_id.append(arg)
+
+        return tuple(composed_id)
+
+
+class NodeCacheStore:
+    """SQLite-backed store of NodeCache analysis, so that LP results are reused between runs and processes
+    Each analysis is keyed by the hash of the model (see bioiso.wrappers.cobraWrapper.model_hash) and by the composed
+    id of the call. The store keeps at most max_size analysis, evicting the least recently used ones"""
 
-            if isinstance(arg, Node):
-                composed_id = composed_id + str(arg.id)
+    def __init__(self, path, max_size=1000000):
+        self.path = path
+        self.max_size = max_size
 
-            if isinstance(arg, bool):
-                composed_id = composed_id + str(arg)
+        self.connection = sqlite3.connect(path, timeout=60)
 
-            if isinstance(arg, list):
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS analysis ("
+                                    "model_hash TEXT NOT NULL, "
+                                    "composed_id TEXT NOT NULL, "
+                                    "analysis INTEGER NOT NULL, "
+                                    "last_used REAL NOT NULL, "
+                                    "PRIMARY KEY (model_hash, composed_id))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS analysis_last_used ON analysis (last_used)")
 
-                for met in arg:
-                    composed_id = composed_id + str(met.id)
+    def load(self, model_hash):
 
-        return composed_id
+        with self.connection:
+            self.connection.execute("UPDATE analysis SET last_used = ? WHERE model_hash = ?",
+                                    (time.time(), model_hash))
+
+            rows = self.connection.execute("SELECT composed_id, analysis FROM analysis WHERE model_hash = ?",
+                                           (model_hash,))
+
+            return {composed_id: bool(analysis) for composed_id, analysis in rows}
+
+    def dump(self, model_hash, analysis):
+
+        last_used = time.time()
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?)",
+                                        ((model_hash, composed_id, int(value), last_used)
+                                         for composed_id, value in analysis.items()))
+
+        self.evict()
+
+    def evict(self):
+
+        with self.connection:
+            size = self.connection.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+
+            if size > self.max_size:
+                self.connection.execute("DELETE FROM analysis WHERE rowid IN "
+                                        "(SELECT rowid FROM analysis ORDER BY last_used LIMIT ?)",
+                                        (size - self.max_size,))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
 
 
 def evaluate_side(boolean):
@@ -140,17 +606,76 @@ def evaluate_side(boolean):
         return 'Product'
 
 
+class SearchSpace:
+    """Distinct metabolites and reactions of a tree, in total and failing ones, as counted by searchSpaceSize and
+    bioisosearchSpaceSize. Nodes are added one at a time, so that the counts are kept while the tree is built"""
+
+    def __init__(self):
+        self.metabolites = set()
+        self.reactions = set()
+        self.failing_metabolites = set()
+        self.failing_reactions = set()
+
+    def add(self, identifier, analysis, reactions):
+
+        """Adds a node, namely its metabolite identifier, its analysis and its reactions as (identifier, flux) pairs"""
+
+        self.metabolites.add(identifier)
+
+        if not analysis:
+            self.failing_metabolites.add(identifier)
+
+        for reaction, flux in reactions:
+
+            self.reactions.add(reaction)
+
+            if not flux:
+                self.failing_reactions.add(reaction)
+
+    def add_tree(self, tree):
+
+        """Adds every node of a results tree (see BioISO.get_tree)"""
+
+        for values in iterate_tree(tree):
+            self.add(values['identifier'], values['analysis'],
+                     ((reaction[0], reaction[1]) for reaction in values['reactions']))
+
+    def stats(self):
+
+        return {'total reactions': len(self.reactions) + 1,
+                'total metabolites': len(self.metabolites) - 1,
+                'bioiso reactions': len(self.failing_reactions),
+                'bioiso metabolites': len(self.failing_metabolites)}
+
+
+def iterate_tree(tree):
+    """Yields the values of every node of a results tree, depth-first, without recursion"""
+
+    stack = [iter(tree.values())]
+
+    while stack:
+
+        values = next(stack[-1], None)
+
+        if values is None:
+            stack.pop()
+            continue
+
+        yield values
+
+        stack.append(iter(values['next'].values()))
+
+
 def searchSpaceSizeRecursive(metabolites, reactions, tree):
+    # it walks the tree iteratively (see iterate_tree), so deep trees do not reach the recursion limit
 
-    for key, values in tree.items():
+    for values in iterate_tree(tree):
 
         metabolites.add(values['identifier'])
 
         for reaction in values['reactions']:
             reactions.add(reaction[0])
 
-        searchSpaceSizeRecursive(metabolites, reactions, values['next'])
-
 
 def searchSpaceSize(tree):
     # length of all next nodes and reactions but without repeat
@@ -164,8 +689,9 @@ def searchSpaceSize(tree):
 
 
 def bioisosearchSpaceSizeRecursive(metabolites, reactions, tree):
+    # it walks the tree iteratively (see iterate_tree), so deep trees do not reach the recursion limit
 
-    for key, values in tree.items():
+    for values in iterate_tree(tree):
 
         if not values['analysis']:
 
@@ -176,8 +702,6 @@ def bioisosearchSpaceSizeRecursive(metabolites, reactions, tree):
             if not reaction[1]:
                 reactions.add(reaction[0])
 
-        bioisosearchSpaceSizeRecursive(metabolites, reactions, values['next'])
-
 
 def bioisosearchSpaceSize(tree):
     # length of all next nodes and reactions but without repeat
@@ -0,0 +1,577 @@
+import json
+from array import array
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+from bioiso.utils.bioisoUtils import evaluate_side
+
+# formats of the results files (see write_results_file)
+RESULTS_FORMATS = ('json', 'ndjson', 'npz')
+
+# analysis, fluxes and pruned flags of the npz results, coded by their position (see tree_arrays)
+RESULTS_VALUES = (False, True, None, 'unknown')
+
+
+def propagate_analysis(node):
+    """Analysis of a node in the results, namely its own analysis corrected by its reactions and next nodes.
+    A successful node fails if any next node fails, whereas a failing node succeeds if any reaction has flux
+    (or an unknown one) or if all next nodes succeed"""
+
+    analysis = node.analysis
+
+    if analysis:
+
+        if node.has_next_nodes():
+
+            false_children = [next_child for next_child in node.get_next()
+                              if not next_child.analysis]
+
+            if len(false_children) > 0:
+                analysis = False
+
+    if not analysis:
+
+        true_rxns = [rxn[1] for rxn in node.reactions_list if rxn[2]]
+
+        if len(true_rxns) > 0:
+            analysis = True
+
+        if node.has_next_nodes() and not analysis:
+
+            true_children = [next_child for next_child in node.get_next()
+                             if next_child.analysis]
+
+            if len(true_children) == len(node.get_next()):
+                analysis = True
+
+    return analysis
+
+
+def node_results(node):
+    """Results of a node, without its next nodes"""
+
+    return {'identifier': node.id,
+            'name': node.name,
+            'compartment': node.compartment,
+            'analysis': propagate_analysis(node),
+            'role': evaluate_side(node.is_reactant),
+            'reactions': [(rxn[1], rxn[2], rxn[3], rxn[4]) for rxn in node.reactions_list],
+            'other_reactions': [(rxn[1], rxn[2], rxn[3], rxn[4]) for rxn in node.other_reactions_list],
+            'pruned': node.pruned}
+
+
+def write_tree(file, nodes, expand=None):
+    """Streams the results of the trees of the given nodes to a file handle, as nested JSON objects keyed by the
+    node hash. The output is the same of json.dump of BioISO.get_tree, but only the path from the root to the current
+    node is kept in memory.
+    If expand is given, it is called with each node and its depth right before writing it, so that the tree is built
+    while written (see BioISO.stream_tree). In this case, the next nodes are released from each node once it is
+    written, so that the nodes of the path and their next nodes are the only ones kept alive"""
+
+    file.write('{')
+
+    # each entry has the iterator of the nodes of a level and whether a node of this level was already written
+    stack = [[iter(nodes), True]]
+
+    while stack:
+
+        level = stack[-1]
+        node = next(level[0], None)
+
+        if node is None:
+
+            stack.pop()
+            file.write('}')
+
+            if stack:
+                file.write('}')
+
+            continue
+
+        if not level[1]:
+            file.write(', ')
+
+        level[1] = False
+
+        if expand is not None:
+            expand(node, len(stack) - 1)
+
+        results = json.dumps(node_results(node))
+
+        file.write(json.dumps(node.get_hash(stringify=True)))
+        file.write(': ')
+        file.write(results[:-1])
+        file.write(', "next": {')
+
+        stack.append([iter(node.get_next()), True])
+
+        if expand is not None:
+            node.next = []
+
+
+def write_tree_lines(file, nodes, expand=None):
+    """Streams the results of the trees of the given nodes to a file handle as NDJSON, namely one JSON object per node
+    and line, with its key (node hash) and the key of its parent (null for the roots). Nodes are written depth-first.
+    See write_tree for expand"""
+
+    stack = [(node, None, 0) for node in reversed(nodes)]
+
+    while stack:
+
+        node, parent, depth = stack.pop()
+
+        if expand is not None:
+            expand(node, depth)
+
+        key = node.get_hash(stringify=True)
+
+        results = {'key': key, 'parent': parent}
+        results.update(node_results(node))
+
+        file.write(json.dumps(results))
+        file.write('\n')
+
+        stack.extend((next_node, key, depth + 1) for next_node in reversed(node.get_next()))
+
+        if expand is not None:
+            node.next = []
+
+
+class StringTable:
+    """Strings of the npz results, each one being coded by its position in the table. None is coded as -1"""
+
+    def __init__(self):
+        self.positions = {}
+        self.strings = []
+
+    def code(self, string):
+
+        if string is None:
+            return -1
+
+        position = self.positions.get(string)
+
+        if position is None:
+            position = len(self.strings)
+            self.positions[string] = position
+            self.strings.append(string)
+
+        return position
+
+    def to_array(self):
+
+        # strings are joined by the null character, which is not expected in identifiers and names
+        return np.frombuffer('\0'.join(self.strings).encode('utf-8'), dtype=np.uint8)
+
+
+def tree_arrays(nodes, expand=None):
+    """NumPy arrays of the results of the trees of the given nodes (see write_tree for expand)
+    Nodes are listed depth-first, each one with the position of its parent (-1 for the roots), and strings are coded
+    by a string table. The (identifier, reactants, products) of the reactions are listed once, and so are the lists
+    of (reaction, flux) of the nodes, as nodes sharing a subtree have the same reactions"""
+
+    strings = StringTable()
+    reactions = {}
+    reactions_lists = {}
+
+    arrays = {name: array('i') for name in ('parent', 'identifier', 'name', 'compartment', 'role', 'reactions',
+                                            'other_reactions', 'list_indptr', 'list_reactions',
+                                            'reaction_identifier', 'reaction_indptr', 'reaction_reactants',
+                                            'reaction_metabolites')}
+
+    arrays.update({name: array('b') for name in ('analysis', 'pruned', 'list_fluxes')})
+
+    arrays['list_indptr'].append(0)
+    arrays['reaction_indptr'].append(0)
+
+    def code_reaction(reaction):
+
+        reaction_key = (reaction[1], tuple(reaction[3]), tuple(reaction[4]))
+        position = reactions.get(reaction_key)
+
+        if position is None:
+            position = len(reactions)
+            reactions[reaction_key] = position
+
+            arrays['reaction_identifier'].append(strings.code(reaction[1]))
+            arrays['reaction_reactants'].append(len(reaction[3]))
+            arrays['reaction_metabolites'].extend(strings.code(metabolite) for metabolite in reaction[3])
+            arrays['reaction_metabolites'].extend(strings.code(metabolite) for metabolite in reaction[4])
+            arrays['reaction_indptr'].append(len(arrays['reaction_metabolites']))
+
+        return position, RESULTS_VALUES.index(reaction[2])
+
+    def code_reactions(reactions_list):
+
+        codes = tuple(code_reaction(reaction) for reaction in reactions_list)
+        position = reactions_lists.get(codes)
+
+        if position is None:
+            position = len(reactions_lists)
+            reactions_lists[codes] = position
+
+            for reaction, flux in codes:
+                arrays['list_reactions'].append(reaction)
+                arrays['list_fluxes'].append(flux)
+
+            arrays['list_indptr'].append(len(arrays['list_reactions']))
+
+        return position
+
+    stack = [(node, -1, 0) for node in reversed(nodes)]
+
+    while stack:
+
+        node, parent, depth = stack.pop()
+
+        if expand is not None:
+            expand(node, depth)
+
+        position = len(arrays['parent'])
+
+        arrays['parent'].append(parent)
+        arrays['identifier'].append(strings.code(node.id))
+        arrays['name'].append(strings.code(node.name))
+        arrays['compartment'].append(strings.code(node.compartment))
+        arrays['role'].append(strings.code(evaluate_side(node.is_reactant)))
+        arrays['analysis'].append(RESULTS_VALUES.index(propagate_analysis(node)))
+        arrays['pruned'].append(RESULTS_VALUES.index(node.pruned))
+
+        arrays['reactions'].append(code_reactions(node.reactions_list))
+        arrays['other_reactions'].append(code_reactions(node.other_reactions_list))
+
+        stack.extend((next_node, position, depth + 1) for next_node in reversed(node.get_next()))
+
+        if expand is not None:
+            node.next = []
+
+    arrays = {name: np.array(values, dtype=np.int32 if values.typecode == 'i' else np.int8)
+              for name, values in arrays.items()}
+
+    arrays['strings'] = strings.to_array()
+
+    return arrays
+
+
+def write_tree_arrays(file, nodes, expand=None):
+    """Writes the results of the trees of the given nodes to a binary file handle, as the compressed npz of their
+    arrays (see tree_arrays). Use load_results to read them"""
+
+    np.savez_compressed(file, **tree_arrays(nodes, expand=expand))
+
+
+def write_results_file(results_f_name, nodes, format='json', expand=None):
+    """Writes the results of the trees of the given nodes to a file in one of RESULTS_FORMATS, namely nested JSON
+    (write_tree), one JSON object per node and line (write_tree_lines) or npz arrays (write_tree_arrays)"""
+
+    if format == 'npz':
+
+        with open(results_f_name, "wb") as npzfile:
+            write_tree_arrays(npzfile, nodes, expand=expand)
+
+        return
+
+    with open(results_f_name, "w") as jsonfile:
+
+        if format == 'json':
+            write_tree(jsonfile, nodes, expand=expand)
+
+        else:
+            write_tree_lines(jsonfile, nodes, expand=expand)
+
+
+class ResultsArrays:
+    """Arrays of npz results (see tree_arrays), with the strings decoded and the next nodes of each node indexed"""
+
+    def __init__(self, arrays):
+
+        self.strings = bytes(arrays['strings']).decode('utf-8').split('\0')
+
+        self.arrays = {name: arrays[name] for name in arrays if name != 'strings'}
+
+        parent = self.arrays['parent']
+
+        # next nodes of each node, keeping the order of the nodes (the roots being the next nodes of -1)
+        self.next_nodes = np.argsort(parent, kind='stable').astype(np.int32)
+
+        self.next_indptr = np.zeros(len(parent) + 2, dtype=np.int64)
+        np.cumsum(np.bincount(parent + 1, minlength=len(parent) + 1), out=self.next_indptr[1:])
+
+        self.reactions = None
+
+    def __len__(self):
+        return len(self.arrays['parent'])
+
+    def string(self, code):
+
+        if code < 0:
+            return None
+
+        return self.strings[code]
+
+    def get_next(self, position):
+
+        start, end = self.next_indptr[position + 1], self.next_indptr[position + 2]
+
+        return self.next_nodes[start:end].tolist()
+
+    def get_reactions(self):
+
+        """(identifier, reactants, products) of the reactions, which are decoded once"""
+
+        if self.reactions is None:
+
+            strings = self.strings
+            identifiers = self.arrays['reaction_identifier'].tolist()
+            indptr = self.arrays['reaction_indptr'].tolist()
+            reactants = self.arrays['reaction_reactants'].tolist()
+            metabolites = [strings[code] for code in self.arrays['reaction_metabolites'].tolist()]
+
+            self.reactions = [(strings[identifier],
+                               metabolites[indptr[position]:indptr[position] + reactants[position]],
+                               metabolites[indptr[position] + reactants[position]:indptr[position + 1]])
+                              for position, identifier in enumerate(identifiers)]
+
+        return self.reactions
+
+    def key(self, position):
+
+        """Key of a node in the results, namely its stringified hash (see Node.get_hash)"""
+
+        return '_'.join((str(self.string(self.arrays['identifier'][position])),
+                         str(self.string(self.arrays['name'][position])),
+                         str(self.string(self.arrays['compartment'][position])),
+                         self.string(self.arrays['role'][position]).lower()))
+
+    def node_reactions(self, position, name):
+
+        reactions = self.get_reactions()
+
+        reactions_list = self.arrays[name][position]
+        start, end = self.arrays['list_indptr'][reactions_list], self.arrays['list_indptr'][reactions_list + 1]
+
+        return [[reactions[reaction][0], RESULTS_VALUES[flux], list(reactions[reaction][1]),
+                 list(reactions[reaction][2])]
+                for reaction, flux in zip(self.arrays['list_reactions'][start:end].tolist(),
+                                          self.arrays['list_fluxes'][start:end].tolist())]
+
+    def node(self, position):
+
+        """Results of a node, without its next nodes"""
+
+        return {'identifier': self.string(self.arrays['identifier'][position]),
+                'name': self.string(self.arrays['name'][position]),
+                'compartment': self.string(self.arrays['compartment'][position]),
+                'analysis': RESULTS_VALUES[self.arrays['analysis'][position]],
+                'role': self.string(self.arrays['role'][position]),
+                'reactions': self.node_reactions(position, 'reactions'),
+                'other_reactions': self.node_reactions(position, 'other_reactions'),
+                'pruned': RESULTS_VALUES[self.arrays['pruned'][position]]}
+
+    def get_tree(self):
+
+        """Nested dict of the results, as loaded from the json results
+        Each reaction is decoded once for each flux, so the reactions of the nodes share these lists"""
+
+        strings = self.strings + [None]
+        values = RESULTS_VALUES
+
+        reactions = [[[identifier, value, reactants, products] for value in values]
+                     for identifier, reactants, products in self.get_reactions()]
+
+        columns = {name: values.tolist() for name, values in self.arrays.items()}
+
+        indptr = columns['list_indptr']
+        list_reactions = columns['list_reactions']
+        list_fluxes = columns['list_fluxes']
+
+        reactions_lists = [[reactions[reaction][flux]
+                            for reaction, flux in zip(list_reactions[indptr[position]:indptr[position + 1]],
+                                                      list_fluxes[indptr[position]:indptr[position + 1]])]
+                           for position in range(len(indptr) - 1)]
+
+        parents = columns['parent']
+        identifiers = [strings[code] for code in columns['identifier']]
+        names = [strings[code] for code in columns['name']]
+        compartments = [strings[code] for code in columns['compartment']]
+        roles = [strings[code] for code in columns['role']]
+
+        tree = {}
+        nodes = []
+
+        for position, parent in enumerate(parents):
+
+            node = {'identifier': identifiers[position],
+                    'name': names[position],
+                    'compartment': compartments[position],
+                    'analysis': values[columns['analysis'][position]],
+                    'role': roles[position],
+                    'reactions': reactions_lists[columns['reactions'][position]][:],
+                    'other_reactions': reactions_lists[columns['other_reactions'][position]][:],
+                    'pruned': values[columns['pruned'][position]],
+                    'next': {}}
+
+            nodes.append(node)
+
+            key = '_'.join((str(identifiers[position]), str(names[position]), str(compartments[position]),
+                            roles[position].lower()))
+
+            if parent < 0:
+                tree[key] = node
+
+            else:
+                nodes[parent]['next'][key] = node
+
+        return tree
+
+    def to_frames(self):
+
+        """Flat tables of the results, namely a nodes DataFrame (node_id, parent_id, depth, metabolite, name,
+        compartment, role, analysis, pruned) and a reactions DataFrame with the reactions of each node (node_id,
+        reaction, flux, reactants, products, other). Nodes are identified by their depth-first position
+        (see tree_arrays), the roots having -1 as parent_id. The reactions of other_reactions have other set to True.
+        The analysis and fluxes are nullable booleans, unknown being missing"""
+
+        strings = np.array(self.strings + [None], dtype=object)
+        booleans = np.array([False, True, None, None], dtype=object)
+
+        parent = self.arrays['parent'].astype(np.int64)
+
+        # nodes are listed depth-first, so the depth is the number of steps to reach a root
+        depth = np.zeros(len(parent), dtype=np.int64)
+        ancestor = parent.copy()
+
+        while (ancestor >= 0).any():
+            depth += ancestor >= 0
+            ancestor = np.where(ancestor >= 0, parent[ancestor], -1)
+
+        nodes = pd.DataFrame({'node_id': np.arange(len(parent), dtype=np.int64),
+                              'parent_id': parent,
+                              'depth': depth,
+                              'metabolite': strings[self.arrays['identifier']],
+                              'name': strings[self.arrays['name']],
+                              'compartment': strings[self.arrays['compartment']],
+                              'role': strings[self.arrays['role']],
+                              'analysis': pd.array(booleans[self.arrays['analysis']], dtype='boolean'),
+                              'pruned': self.arrays['pruned'].astype(bool)})
+
+        reactions = self.get_reactions()
+
+        reactions_ids = strings[self.arrays['reaction_identifier']]
+        reactants = np.empty(len(reactions), dtype=object)
+        products = np.empty(len(reactions), dtype=object)
+        reactants[:] = [reaction[1] for reaction in reactions]
+        products[:] = [reaction[2] for reaction in reactions]
+
+        indptr = self.arrays['list_indptr'].astype(np.int64)
+
+        frames = []
+
+        for name in ('reactions', 'other_reactions'):
+
+            # entries of the reactions list of each node, in order
+            starts = indptr[self.arrays[name]]
+            lengths = indptr[self.arrays[name] + 1] - starts
+
+            offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            entries = np.repeat(starts, lengths) + offsets
+
+            reaction = self.arrays['list_reactions'][entries]
+
+            frames.append(pd.DataFrame({'node_id': np.repeat(np.arange(len(parent), dtype=np.int64), lengths),
+                                        'reaction': reactions_ids[reaction],
+                                        'flux': pd.array(booleans[self.arrays['list_fluxes'][entries]],
+                                                         dtype='boolean'),
+                                        'reactants': reactants[reaction],
+                                        'products': products[reaction],
+                                        'other': name == 'other_reactions'}))
+
+        reactions = pd.concat(frames, ignore_index=True)
+        reactions = reactions.sort_values('node_id', kind='stable', ignore_index=True)
+
+        return nodes, reactions
+
+
+class ResultsView(Mapping):
+    """Read-only view of the nested dict of npz results, in which nodes are only decoded when accessed"""
+
+    def __init__(self, results, positions):
+        self.results = results
+        self.positions = positions
+        self.__keys = None
+
+    def __keys_positions(self):
+
+        if self.__keys is None:
+            # as in a dict, the last node of a repeated key replaces the previous one
+            self.__keys = {}
+
+            for position in self.positions:
+                self.__keys[self.results.key(position)] = position
+
+        return self.__keys
+
+    def __getitem__(self, key):
+        return NodeView(self.results, self.__keys_positions()[key])
+
+    def __iter__(self):
+        return iter(self.__keys_positions())
+
+    def __len__(self):
+        return len(self.__keys_positions())
+
+
+class NodeView(Mapping):
+    """Read-only view of the results of a node of npz results, with the view of its next nodes (see ResultsView)"""
+
+    def __init__(self, results, position):
+        self.results = results
+        self.position = position
+        self.__node = None
+
+    def __getitem__(self, key):
+
+        if key == 'next':
+            return ResultsView(self.results, self.results.get_next(self.position))
+
+        if self.__node is None:
+            self.__node = self.results.node(self.position)
+
+        return self.__node[key]
+
+    def __iter__(self):
+        return iter(('identifier', 'name', 'compartment', 'analysis', 'role', 'reactions', 'other_reactions',
+                     'pruned', 'next'))
+
+    def __len__(self):
+        return 9
+
+
+def load_frames(results_f_name):
+    """Loads the nodes and reactions DataFrames of npz results (see ResultsArrays.to_frames), without building
+    the nested dict"""
+
+    with np.load(results_f_name, allow_pickle=False) as npzfile:
+        results = ResultsArrays({name: npzfile[name] for name in npzfile.files})
+
+    return results.to_frames()
+
+
+def load_results(results_f_name, lazy=False):
+    """Loads the results written by BioISO.write_results in json or npz format (the latter by its extension)
+    It returns the nested dict of the results (see BioISO.get_tree). If lazy, npz results are returned as a read-only
+    view of this dict (see ResultsView), whose nodes are only decoded when accessed"""
+
+    if not results_f_name.endswith('.npz'):
+
+        with open(results_f_name) as jsonfile:
+            return json.load(jsonfile)
+
+    with np.load(results_f_name, allow_pickle=False) as npzfile:
+        results = ResultsArrays({name: npzfile[name] for name in npzfile.files})
+
+    if lazy:
+        return ResultsView(results, results.get_next(-1))
+
+    return results.get_tree()
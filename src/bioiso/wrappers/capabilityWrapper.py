@@ -0,0 +1,383 @@
+from optlang.interface import OPTIMAL
+from optlang.symbolics import Zero
+import numpy as np
+
+from bioiso import BoundsFingerprint, NodeCache, INFEASIBLE
+from bioiso.wrappers.cobraWrapper import evalSlimSol, get_reaction, create_unbalenced_reaction, record_witness, \
+    harvest_masks, HARVEST_TOL
+
+# capability of a reaction in a FluxCapabilities table
+CAPABLE = 1
+BLOCKED = 0
+NOT_EVALUATED = -1
+
+
+class FluxCapabilities:
+    """Analysis of simulate_reaction for every reaction of a model in both directions, in NumPy arrays in the order of
+    model.reactions. Each LP solution settles every other reaction carrying flux in it (see harvest_masks), so only
+    the reactions not covered by a previous solution are solved. It is a snapshot of the model state (see holds)"""
+
+    def __init__(self, model, tol=1E-08):
+
+        self.reactions_ids = [reaction.id for reaction in model.reactions]
+        self.reactions_positions = {reaction_id: position for position, reaction_id in enumerate(self.reactions_ids)}
+        self.state = BoundsFingerprint(model).state
+
+        self.maximize = np.full(len(self.reactions_ids), NOT_EVALUATED, dtype=np.int8)
+        self.minimize = np.full(len(self.reactions_ids), NOT_EVALUATED, dtype=np.int8)
+
+        # number of LPs solved to fill the table
+        self.lps = 0
+
+        self.__evaluate(model, tol)
+
+    def __evaluate(self, model, tol):
+
+        reactions = list(model.reactions)
+
+        lower_bounds = np.array([reaction.lower_bound for reaction in reactions], dtype=float)
+        upper_bounds = np.array([reaction.upper_bound for reaction in reactions], dtype=float)
+
+        variables = [(reaction.forward_variable, reaction.reverse_variable) for reaction in reactions]
+        names = [(forward.name, reverse.name) for forward, reverse in variables]
+
+        maximize = upper_bounds > 0
+        minimize = lower_bounds < 0
+
+        # the maximize solutions are only witnesses if the objective direction is max (see harvest_solution)
+        direction = model.solver.objective.direction
+
+        # an unbounded maximize LP is not optimal, so reactions with an infinite upper bound are always solved
+        maximize_witness = maximize & (upper_bounds < float('inf')) & (direction == 'max')
+
+        # the minimize LP sets the reaction bounds to (-999999, 0)
+        minimize_witness = minimize & (lower_bounds >= -999999)
+
+        def harvest():
+
+            # fluxes just above the tolerance may be noise of the solver (see harvest_solution)
+            maximize_proved, minimize_proved = harvest_masks(model.solver.primal_values, names, maximize_witness,
+                                                             minimize_witness)
+
+            self.maximize[maximize_proved & (self.maximize == NOT_EVALUATED)] = CAPABLE
+            self.minimize[minimize_proved & (self.minimize == NOT_EVALUATED)] = CAPABLE
+
+        objective_expression = model.solver.objective.expression
+
+        objective = model.problem.Objective(Zero, direction=direction)
+        model.solver.objective = objective
+        objective = model.solver.objective
+
+        try:
+
+            # the directions of irreversible reactions are evaluated in a batch first
+            self.__evaluate_batch(model, tol, variables, maximize_witness & (upper_bounds >= tol) & (lower_bounds >= 0),
+                                  minimize_witness & (lower_bounds <= -tol) & (upper_bounds <= 0), harvest)
+
+            for position, (forward, reverse) in enumerate(variables):
+
+                if maximize[position] and self.maximize[position] == NOT_EVALUATED:
+
+                    objective.set_linear_coefficients({forward: 1, reverse: -1})
+                    objective.direction = direction
+
+                    value = self.__solve(model)
+
+                    self.maximize[position] = CAPABLE if evalSlimSol(value, tol) else BLOCKED
+
+                    if model.solver.status == OPTIMAL:
+                        harvest()
+
+                    objective.set_linear_coefficients({forward: 0, reverse: 0})
+
+                if minimize[position] and self.minimize[position] == NOT_EVALUATED:
+
+                    bounds = (forward.lb, forward.ub, reverse.lb, reverse.ub)
+
+                    forward.set_bounds(0, 0)
+                    reverse.set_bounds(0, 999999)
+
+                    objective.set_linear_coefficients({forward: 1, reverse: -1})
+                    objective.direction = 'min'
+
+                    value = self.__solve(model)
+
+                    self.minimize[position] = CAPABLE if evalSlimSol(value, tol) else BLOCKED
+
+                    forward.set_bounds(bounds[0], bounds[1])
+                    reverse.set_bounds(bounds[2], bounds[3])
+
+                    # the solution is only a witness if it is feasible within the bounds of the reaction
+                    if model.solver.status == OPTIMAL:
+
+                        primals = model.solver.primal_values
+                        flux = primals[forward.name] - primals[reverse.name]
+
+                        if lower_bounds[position] <= flux <= upper_bounds[position]:
+                            harvest()
+
+                    objective.set_linear_coefficients({forward: 0, reverse: 0})
+
+        finally:
+
+            model.solver.objective = model.problem.Objective(objective_expression, direction=direction, sloppy=True)
+
+    def __evaluate_batch(self, model, tol, variables, maximize, minimize, harvest):
+
+        """Proves blocked directions in a batch (see maximize_capacities). The capacities would force the flux of
+        reversible reactions into their direction, so only irreversible ones can be batched.
+        The directions left are solved one by one"""
+
+        objective = model.solver.objective
+
+        fluxes = {}
+
+        for sign, directions in ((1, maximize), (-1, minimize)):
+
+            for position in np.flatnonzero(directions).tolist():
+
+                forward, reverse = variables[position]
+                fluxes[(sign, position)] = {forward: sign, reverse: -sign}
+
+        def capabilities(sign):
+            return self.maximize if sign > 0 else self.minimize
+
+        def solve(coefficients):
+
+            objective.set_linear_coefficients(coefficients)
+            objective.direction = 'max'
+
+            return self.__solve(model)
+
+        def settle(keys):
+
+            harvest()
+
+            return [(sign, position) for sign, position in keys if capabilities(sign)[position] != NOT_EVALUATED]
+
+        def block(keys):
+
+            for sign, position in keys:
+                capabilities(sign)[position] = BLOCKED
+
+        def clear(coefficients):
+            objective.set_linear_coefficients({capacity: 0 for capacity in coefficients})
+
+        maximize_capacities(model, fluxes, solve, settle, block, clear, tol, 'bioiso_capacity')
+
+    def __solve(self, model):
+
+        self.lps += 1
+
+        model.solver.optimize()
+
+        if model.solver.status == OPTIMAL:
+            return model.solver.objective.value
+
+        return np.nan
+
+    def holds(self, model):
+
+        """Whether the table is a snapshot of the current state of the model, including its objective direction"""
+
+        return BoundsFingerprint(model).state == self.state
+
+    def get(self, reaction_id, is_maximize):
+
+        """Analysis of simulate_reaction for the reaction in the given direction, or None if it was not evaluated"""
+
+        position = self.reactions_positions[reaction_id]
+
+        capability = self.maximize[position] if is_maximize else self.minimize[position]
+
+        if capability == NOT_EVALUATED:
+            return None
+
+        return bool(capability)
+
+    def items(self):
+
+        """Yields the (composed id, analysis) pairs of simulate_reaction for every reaction evaluated, namely the keys
+        of the node cache (see NodeCache.create_composed_ids)"""
+
+        for is_maximize, capabilities in ((True, self.maximize), (False, self.minimize)):
+
+            for position in np.flatnonzero(capabilities != NOT_EVALUATED).tolist():
+                yield ('simulate_reaction', self.reactions_ids[position], is_maximize), bool(capabilities[position])
+
+    def stats(self):
+
+        """Counts of capable and blocked reactions in each direction, and the number of LPs solved"""
+
+        return {'maximize capable': int(np.count_nonzero(self.maximize == CAPABLE)),
+                'maximize blocked': int(np.count_nonzero(self.maximize == BLOCKED)),
+                'minimize capable': int(np.count_nonzero(self.minimize == CAPABLE)),
+                'minimize blocked': int(np.count_nonzero(self.minimize == BLOCKED)),
+                'lps': self.lps}
+
+
+def maximize_capacities(model, fluxes, solve, settle, block, clear, tol=1E-08, name='bioiso_capacity'):
+    """Consistency check of FASTCC for several fluxes, given by their linear coefficients and keyed by any key
+    A capacity variable z, 0 <= z <= 1, is added for each flux, with z <= flux, and the sum of the capacities is
+    maximized. settle reads each solution and returns the keys it settles, whose capacities are then closed. Once the
+    optimum is below the tolerance (or the LP is infeasible), no flux left can be positive, so block gets their keys.
+    If a solution settles no key, the ones left are not settled.
+    solve solves the LP for the given objective coefficients, returning the optimum or nan, and clear sets these
+    coefficients to zero"""
+
+    interface = model.problem
+
+    capacities = {}
+    constraints = []
+
+    for position, (key, coefficients) in enumerate(fluxes.items()):
+
+        capacity = interface.Variable('{}_{}'.format(name, position), lb=0, ub=1)
+
+        flux = sum(coefficient * variable for variable, coefficient in coefficients.items())
+        constraints.append(interface.Constraint(capacity - flux, ub=0, name='{}_{}'.format(name, position)))
+
+        capacities[key] = capacity
+
+    if not capacities:
+        return
+
+    added = list(capacities.values())
+
+    model.solver.add(added)
+    model.solver.add(constraints)
+    model.solver.update()
+
+    coefficients = {capacity: 1 for capacity in added}
+
+    try:
+
+        while capacities:
+
+            value = solve(coefficients)
+
+            if np.isnan(value) or value < tol:
+                block(list(capacities))
+                return
+
+            settled = settle(list(capacities))
+
+            if not settled:
+                return
+
+            for key in settled:
+                capacities.pop(key).ub = 0
+
+    finally:
+
+        clear(coefficients)
+
+        model.solver.remove(constraints)
+        model.solver.remove(added)
+        model.solver.update()
+
+
+def screen_nodes(bioiso_id, model, reactants_ids, products_ids, nodes, tol=1E-08, engine=None, compressed=None):
+    """Screens in bulk the nodes of a reaction, namely (metabolite_id, is_reactant) pairs, whose LPs in
+    simulate_reactants and simulate_products share the same drains (the reactants drained and the products supplied),
+    so they only differ in the objective (see screen_drains). The analysis settled are added to the node cache of the
+    Bioiso instance, while the nodes left are evaluated by their own LPs. The reactants are only screened if the
+    objective direction is max (see harvest_solution)"""
+
+    if compressed is not None and compressed.retains(reactants_ids + products_ids):
+        model, engine = compressed.model, compressed.engine
+
+    direction = engine.direction if engine is not None else model.solver.objective.direction
+
+    if direction != 'max':
+        nodes = [(metabolite_id, is_reactant) for metabolite_id, is_reactant in nodes if not is_reactant]
+
+    if bioiso_id not in NodeCache.bioiso_instances or not nodes:
+        return
+
+    if engine is not None:
+
+        try:
+
+            drains = {}
+
+            for product_id in products_ids:
+                drains[(product_id, False)] = engine.drain_coefficients(engine.open_drain(product_id, (-999999, 0)))
+
+            for reactant_id in reactants_ids:
+                drains[(reactant_id, True)] = engine.drain_coefficients(engine.open_drain(reactant_id, (0, 999999)))
+
+            screen_drains(bioiso_id, engine.model, reactants_ids, products_ids, nodes, drains,
+                          lambda coefficients: engine.solve(coefficients, 'max'),
+                          lambda coefficients: engine.set_objective({}, 'max'), tol)
+
+        finally:
+            engine.reset()
+
+        return
+
+    with model as m:
+
+        drains = {}
+
+        for product_id, is_reactant, bounds in [(product_id, False, (-999999, 0)) for product_id in products_ids] + \
+                                               [(reactant_id, True, (0, 999999)) for reactant_id in reactants_ids]:
+
+            reaction = get_reaction(m, create_unbalenced_reaction(m, product_id, bounds))
+            drains[(product_id, is_reactant)] = {reaction.forward_variable: 1, reaction.reverse_variable: -1}
+
+        m.objective = m.problem.Objective(Zero, direction='max')
+
+        def solve(coefficients):
+            m.solver.objective.set_linear_coefficients(coefficients)
+
+            return m.slim_optimize()
+
+        def clear(coefficients):
+            m.solver.objective.set_linear_coefficients({variable: 0 for variable in coefficients})
+
+        screen_drains(bioiso_id, m, reactants_ids, products_ids, nodes, drains, solve, clear, tol)
+
+
+def screen_drains(bioiso_id, model, reactants_ids, products_ids, nodes, drains, solve, clear, tol=1E-08):
+    """Settles the analysis of several nodes with the LPs of a single family (see maximize_capacities), whose fluxes
+    are the ones of the drains of the nodes (or -flux, for products). A node whose drain has a flux of at least
+    HARVEST_TOL in a solution is True, and once the optimum is below the tolerance, every node left is False, as the
+    LP of each node alone is bounded by the sum.
+    The drains are the linear coefficients of the flux of the drain of each node (see maximize_capacities for solve
+    and clear)"""
+
+    node_registry = NodeCache.bioiso_instances[bioiso_id]
+
+    fluxes = {node: {variable: coefficient * (1 if node[1] else -1)
+                     for variable, coefficient in drains[node].items()} for node in nodes}
+
+    def composed_id(node):
+        return ('simulate_reactants' if node[1] else 'simulate_products', node[0], reactants_ids, products_ids)
+
+    def screen(coefficients):
+
+        node_registry.screen_lps += 1
+
+        return solve(coefficients)
+
+    def settle(nodes_left):
+
+        node_registry.witness = None
+        record_witness(bioiso_id, model)
+
+        primals = model.solver.primal_values
+
+        settled = [node for node in nodes_left
+                   if sum(coefficient * primals[variable.name]
+                          for variable, coefficient in fluxes[node].items()) >= HARVEST_TOL]
+
+        node_registry.add_screened([composed_id(node) for node in settled], True, node_registry.witness)
+
+        return settled
+
+    # the LP of each node is bounded by the LP of the family (see NodeRegistry.infer for the witness)
+    def block(nodes_left):
+        node_registry.add_screened([composed_id(node) for node in nodes_left], False, INFEASIBLE)
+
+    maximize_capacities(model, fluxes, screen, settle, block, clear, tol, 'bioiso_screen')
@@ -1,13 +1,24 @@
 from cobra import io, Reaction
-from cobra.flux_analysis import single_reaction_deletion
-from bioiso import NodeCache
+from cobra.exceptions import OptimizationError
+from cobra.flux_analysis import pfba
+from bioiso import NodeCache, INFEASIBLE
+from bioiso.wrappers.indexWrapper import MAXIMIZE, MINIMIZE, UNKNOWN, ReactionRecords
 import numpy as np
+import multiprocessing
 import random
+import hashlib
 
 import warnings
 
 warnings.filterwarnings("ignore")
 
+# isMaximize value of each role of a StoichiometricIndex
+INDEX_ROLES = {MAXIMIZE: True, MINIMIZE: False, UNKNOWN: None}
+
+# lowest flux harvested from an LP solution (see harvest_solution), as fluxes just above the tolerance of the analysis
+# may be noise of the solver, e.g. in loops of reactions bounded by 999999
+HARVEST_TOL = 1E-06
+
 
 def load(file_name):
     try:
@@ -76,6 +87,23 @@ def get_reactions(model, metabolite_id):
     return get_metabolite(model, metabolite_id).reactions
 
 
+def model_hash(model):
+    """Content hash of the model, namely the bounds and stoichiometry of every reaction, the solver interface and the
+    direction of the model objective, in which the maximize LPs are solved. LP results of models with the same hash are
+    the same"""
+
+    content = hashlib.sha1(model.solver.interface.__name__.encode())
+    content.update(model.solver.objective.direction.encode())
+
+    for reaction in sorted(model.reactions, key=lambda x: x.id):
+
+        content.update(repr((reaction.id, reaction.lower_bound, reaction.upper_bound,
+                             sorted((metabolite.id, coefficient)
+                                    for metabolite, coefficient in reaction.metabolites.items()))).encode())
+
+    return content.hexdigest()
+
+
 def create_unbalenced_reaction(model, metabolite_id, bounds=(-999999, 999999)):
     # bounds = (0, 999999)
     # demand - unbalanced network reaction that only allows the accumulation of a compound
@@ -103,112 +131,136 @@ def create_unbalenced_reaction(model, metabolite_id, bounds=(-999999, 999999)):
         return reaction_name
 
 
-def get_reactions_by_role(bioiso_id, model, metabolite_id, isReactant, previous_reactions_list):
-    reactions = get_reactions(model, metabolite_id)
+def get_reactions_roles(model, metabolite_id, isReactant, index=None):
+    """Lists the (reaction, maximize) pairs of the reactions of a metabolite, maximize being given by isMaximize
+    With a StoichiometricIndex, the roles of all reactions are classified at once, and the reactions are listed in the
+    order of model.reactions"""
+
+    if index is None:
+
+        metabolite = get_metabolite(model, metabolite_id)
+
+        return [(reaction, isMaximize(model, reaction, metabolite, isReactant))
+                for reaction in get_reactions(model, metabolite_id)]
+
+    reactions_indices, roles = index.roles(metabolite_id, isReactant)
+
+    return [(index.reactions[position], INDEX_ROLES[role])
+            for position, role in zip(reactions_indices.tolist(), roles.tolist())]
+
+
+def new_reactions_list(model, records, index=None):
+    """Creates a reactions_list from (reaction, flux, forward) records, namely a list of
+    (reaction, reaction id, flux, ids, ids, metabolites, metabolites) tuples, where the reactants come first if forward
+    is True and the products otherwise. Reactions whose flux is unknown only have the ids.
+    With a StoichiometricIndex, it creates compact ReactionRecords instead, which only keep the reaction positions"""
+
+    if index is not None:
+        return ReactionRecords(index, [(index.reactions_positions[reaction.id], flux, forward)
+                                       for reaction, flux, forward in records])
 
     reactions_list = []
-    other_reactions_list = []
 
-    last_reactions_ids = list(map(lambda x: x[1], previous_reactions_list))
+    for reaction, flux, forward in records:
 
-    for reaction in reactions:
+        if forward:
+            ids = (list_reactants_ids(model, reaction.id), list_products_ids(model, reaction.id))
+            metabolites = (get_reactants(model, reaction.id), get_products(model, reaction.id))
 
-        if reaction.id not in last_reactions_ids:
+        else:
+            ids = (list_products_ids(model, reaction.id), list_reactants_ids(model, reaction.id))
+            metabolites = (get_products(model, reaction.id), get_reactants(model, reaction.id))
 
-            maximize = isMaximize(model, reaction, get_metabolite(model, metabolite_id), isReactant)
+        if flux == 'unknown':
+            reactions_list.append((reaction, reaction.id, flux) + ids)
 
-            if maximize is None:
+        else:
+            reactions_list.append((reaction, reaction.id, flux) + ids + metabolites)
+
+    return reactions_list
+
+
+def get_reactions_by_role(bioiso_id, model, metabolite_id, isReactant, previous_reactions_list, engine=None,
+                          index=None, compressed=None):
+    reactions_list = []
+    other_reactions_list = []
+
+    last_reactions_ids = {reaction[1] for reaction in previous_reactions_list}
 
-                other_reactions_list.append((reaction, reaction.id, 'unknown',
-                                             list_reactants_ids(model, reaction.id),
-                                             list_products_ids(model, reaction.id)))
+    for reaction, maximize in get_reactions_roles(model, metabolite_id, isReactant, index):
 
-            elif maximize:
+        if reaction.id not in last_reactions_ids:
+
+            if maximize is None:
 
-                reactions_list.append((reaction, reaction.id,
-                                       simulate_reaction(bioiso_id, model, reaction, maximize),
-                                       list_reactants_ids(model, reaction.id),
-                                       list_products_ids(model, reaction.id),
-                                       get_reactants(model, reaction.id),
-                                       get_products(model, reaction.id)))
+                other_reactions_list.append((reaction, 'unknown', True))
 
             else:
 
-                reactions_list.append((reaction, reaction.id,
-                                       simulate_reaction(bioiso_id, model, reaction, maximize),
-                                       list_products_ids(model, reaction.id),
-                                       list_reactants_ids(model, reaction.id),
-                                       get_products(model, reaction.id),
-                                       get_reactants(model, reaction.id)))
+                reactions_list.append((reaction,
+                                       simulate_reaction(bioiso_id, model, reaction, maximize, engine=engine,
+                                                         compressed=compressed),
+                                       maximize))
 
-    return reactions_list, other_reactions_list
+    return new_reactions_list(model, reactions_list, index), new_reactions_list(model, other_reactions_list, index)
 
 
-def get_reactions_by_role_fast(bioiso_id, model, metabolite_id, isReactant, previous_reactions_list):
-    reactions = get_reactions(model, metabolite_id)
+def get_reactions_by_role_fast(bioiso_id, model, metabolite_id, isReactant, previous_reactions_list, engine=None,
+                               index=None, compressed=None):
+    reactions_roles = get_reactions_roles(model, metabolite_id, isReactant, index)
 
-    n_reactions = len(reactions)
+    n_reactions = len(reactions_roles)
 
     if n_reactions >= 20:
 
         reactions_list = []
 
-        last_reactions_ids = list(map(lambda x: x[1], previous_reactions_list))
+        last_reactions_ids = {reaction[1] for reaction in previous_reactions_list}
 
         n_test_set = round(n_reactions * 0.1)
 
-        reactions_in_list = list(reactions)
+        test_set = reactions_roles[:n_test_set]
+        unknown_set = reactions_roles[n_test_set:]
 
-        test_set = reactions_in_list[:n_test_set]
-        unknown_set = reactions_in_list[n_test_set:]
-
-        for reaction in test_set:
+        for reaction, maximize in test_set:
 
             if reaction.id not in last_reactions_ids:
 
-                maximize = isMaximize(model, reaction, get_metabolite(model, metabolite_id), isReactant)
-
-                if maximize:
+                reactions_list.append((reaction,
+                                       simulate_reaction(bioiso_id, model, reaction, maximize, engine=engine,
+                                                         compressed=compressed),
+                                       bool(maximize)))
 
-                    reactions_list.append((reaction, reaction.id,
-                                           simulate_reaction(bioiso_id, model, reaction, maximize),
-                                           list_reactants_ids(model, reaction.id),
-                                           list_products_ids(model, reaction.id),
-                                           get_reactants(model, reaction.id),
-                                           get_products(model, reaction.id)))
+        for reaction, maximize in unknown_set:
 
-                else:
+            if not reaction.boundary and reaction.id not in last_reactions_ids:
 
-                    reactions_list.append((reaction, reaction.id,
-                                           simulate_reaction(bioiso_id, model, reaction, maximize),
-                                           list_products_ids(model, reaction.id),
-                                           list_reactants_ids(model, reaction.id),
-                                           get_products(model, reaction.id),
-                                           get_reactants(model, reaction.id)))
+                reactions_list.append((reaction, 'unknown', bool(maximize)))
 
-        for reaction in unknown_set:
+        return new_reactions_list(model, reactions_list, index), new_reactions_list(model, [], index)
 
-            if not reaction.boundary and reaction.id not in last_reactions_ids:
+    else:
 
-                maximize = isMaximize(model, reaction, get_metabolite(model, metabolite_id), isReactant)
+        return get_reactions_by_role(bioiso_id, model, metabolite_id, isReactant, previous_reactions_list, engine,
+                                     index, compressed)
 
-                if maximize:
 
-                    reactions_list.append((reaction, reaction.id, 'unknown',
-                                           list_reactants_ids(model, reaction.id),
-                                           list_products_ids(model, reaction.id)))
+def list_reactions_to_simulate(model, metabolite_id, isReactant, previous_reactions_list, fast=False, index=None):
+    """Lists the (reaction, maximize) pairs for which get_reactions_by_role (or get_reactions_by_role_fast) will call
+    simulate_reaction, without solving any LP. It is used to plan the evaluation of a whole frontier of nodes"""
 
-                else:
+    reactions_roles = get_reactions_roles(model, metabolite_id, isReactant, index)
 
-                    reactions_list.append((reaction, reaction.id, 'unknown',
-                                           list_products_ids(model, reaction.id),
-                                           list_reactants_ids(model, reaction.id)))
+    last_reactions_ids = {reaction[1] for reaction in previous_reactions_list}
 
-        return reactions_list, []
+    # the fast version only simulates the first 10% of the reactions, even when isMaximize is None
+    fast = fast and len(reactions_roles) >= 20
 
-    else:
+    if fast:
+        reactions_roles = reactions_roles[:round(len(reactions_roles) * 0.1)]
 
-        return get_reactions_by_role(bioiso_id, model, metabolite_id, isReactant, previous_reactions_list)
+    return [(reaction, maximize) for reaction, maximize in reactions_roles
+            if reaction.id not in last_reactions_ids and (maximize is not None or fast)]
 
 
 def isMaximize(model, reaction, metabolite, isReactant):
@@ -287,8 +339,101 @@ def isMaximize(model, reaction, metabolite, isReactant):
                 return None
 
 
+def record_witness(bioiso_id, model):
+    """Records the flux of the watched reactions in the last LP solution (or INFEASIBLE) as the witness of the
+    analysis being computed, so that it can be reused by states that only tighten the bounds of these reactions"""
+
+    node_registry = NodeCache.bioiso_instances.get(bioiso_id)
+
+    if node_registry is None or not node_registry.storage.watched:
+        return
+
+    status = model.solver.status
+
+    if status == 'infeasible':
+        node_registry.witness = INFEASIBLE
+
+    elif status == 'optimal':
+        reactions = [get_reaction(model, reaction_id) for reaction_id in node_registry.storage.watched
+                     if has_reaction(model, reaction_id)]
+
+        node_registry.witness = {reaction.id: reaction.forward_variable.primal - reaction.reverse_variable.primal
+                                 for reaction in reactions}
+
+
+def harvest_masks(primals, names, maximize, minimize, tol=HARVEST_TOL):
+    """Masks of the reactions whose maximize (or minimize) LP is proved feasible by an LP solution, namely the ones in
+    maximize with a flux of at least the tolerance (or in minimize with a flux of at most minus the tolerance), given
+    the primal values of the solution and the names of the forward and reverse variables of the reactions"""
+
+    fluxes = np.fromiter((primals[forward] - primals[reverse] for forward, reverse in names), dtype=float,
+                         count=len(names))
+
+    return maximize & (fluxes >= tol), minimize & (fluxes <= -tol)
+
+
+def harvest_solution(bioiso_id, model, maximize_witness, reaction=None, bounds=None, tol=HARVEST_TOL):
+    """Harvests the last LP solution, namely the analysis of simulate_reaction it proves. A solution with flux above the
+    tolerance in a reaction (or below minus the tolerance) proves that its maximize LP (or minimize LP) is feasible.
+    Only solutions of the model itself are harvested, so if the LP changed the bounds of a reaction, its flux must be
+    within the given bounds. As cobra slim_optimize maximizes in the direction of the model objective, maximize
+    analysis are only proved if maximize_witness, namely if this direction is max"""
+
+    node_registry = NodeCache.bioiso_instances.get(bioiso_id)
+
+    if node_registry is None or not node_registry.harvest or model.solver.status != 'optimal':
+        return
+
+    if id(model) not in node_registry.harvest_reactions:
+        # the reactions are read once for each model state (see NodeRegistry.set_state), and for each model, as the LPs
+        # may be solved in a CompressedModel
+        reactions = list(model.reactions)
+
+        node_registry.harvest_reactions[id(model)] = ([reaction.id for reaction in reactions],
+                                           [(reaction.forward_variable.name, reaction.reverse_variable.name)
+                                            for reaction in reactions],
+                                           np.array([reaction.upper_bound < float('inf') for reaction in reactions]),
+                                           np.array([reaction.lower_bound >= -999999 for reaction in reactions]))
+
+    reactions_ids, names, maximize, minimize = node_registry.harvest_reactions[id(model)]
+
+    primals = model.solver.primal_values
+
+    if reaction is not None:
+
+        flux = primals[reaction.forward_variable.name] - primals[reaction.reverse_variable.name]
+
+        if not bounds[0] <= flux <= bounds[1]:
+            return
+
+    maximize, minimize = harvest_masks(primals, names, maximize, minimize, tol)
+
+    composed_ids = []
+
+    if maximize_witness:
+        composed_ids.extend(('simulate_reaction', reactions_ids[position], True)
+                            for position in np.flatnonzero(maximize).tolist())
+
+    composed_ids.extend(('simulate_reaction', reactions_ids[position], False)
+                        for position in np.flatnonzero(minimize).tolist())
+
+    node_registry.add_harvested(composed_ids, True, node_registry.witness)
+
+
 @NodeCache
-def simulate_reaction(bioiso_id, model, reaction, is_maximize, tol=1E-08):
+def simulate_reaction(bioiso_id, model, reaction, is_maximize, tol=1E-08, engine=None, compressed=None):
+    if compressed is not None:
+
+        if is_maximize and compressed.is_blocked(reaction.id):
+            return record_blocked(bioiso_id)
+
+        if compressed.retains(reaction_id=reaction.id):
+            model, engine = compressed.model, compressed.engine
+            reaction = get_reaction(model, reaction.id)
+
+    if engine is not None:
+        return simulate_reaction_engine(bioiso_id, engine, reaction, is_maximize, tol)
+
     with model as m:
 
         if is_maximize:
@@ -297,21 +442,69 @@ def simulate_reaction(bioiso_id, model, reaction, is_maximize, tol=1E-08):
 
             solution = m.slim_optimize()
 
+            record_witness(bioiso_id, m)
+
+            harvest_solution(bioiso_id, m, m.solver.objective.direction == 'max')
+
             return evalSlimSol(solution, tol)
 
         else:
 
+            bounds = reaction.bounds
+
             get_reaction(m, reaction.id).bounds = (-999999, 0)
 
             set_objective_function(m, reaction.id)
 
             solution = m.optimize(objective_sense='minimize')
 
+            record_witness(bioiso_id, m)
+
+            harvest_solution(bioiso_id, m, m.solver.objective.direction == 'max', reaction, bounds)
+
             return evalSol(solution, tol)
 
 
+def record_blocked(bioiso_id):
+    """Records an analysis of a reaction blocked in a CompressedModel without solving the LP, which is False and
+    INFEASIBLE (see NodeRegistry.infer)"""
+
+    node_registry = NodeCache.bioiso_instances.get(bioiso_id)
+
+    if node_registry is not None:
+        node_registry.witness = INFEASIBLE
+        node_registry.blocked += 1
+
+    return False
+
+
+def record_prefiltered(bioiso_id):
+    """Records an analysis settled by the NetworkExpansion without solving the LP, which is False and INFEASIBLE
+    (see NodeRegistry.infer)"""
+
+    node_registry = NodeCache.bioiso_instances.get(bioiso_id)
+
+    if node_registry is not None:
+        node_registry.witness = INFEASIBLE
+        node_registry.prefiltered += 1
+
+    return False
+
+
 @NodeCache
-def simulate_reactants(bioiso_id, model, node, reactants, products, tol=1E-08):
+def simulate_reactants(bioiso_id, model, node, reactants, products, tol=1E-08, engine=None, expansion=None,
+                       compressed=None):
+    if expansion is not None and expansion.blocks(node, reactants, products):
+        return record_prefiltered(bioiso_id)
+
+    if compressed is not None:
+
+        if compressed.retains([node.id] + [metabolite.id for metabolite in reactants + products]):
+            model, engine = compressed.model, compressed.engine
+
+    if engine is not None:
+        return simulate_reactants_engine(bioiso_id, engine, node, reactants, products, tol)
+
     with model as m:
 
         for product in products:
@@ -332,11 +525,25 @@ def simulate_reactants(bioiso_id, model, node, reactants, products, tol=1E-08):
         # using fba, which is much much much faster than pFBA
         solution = m.slim_optimize()
 
+        record_witness(bioiso_id, m)
+
     return evalSlimSol(solution, tol)
 
 
 @NodeCache
-def simulate_products(bioiso_id, model, node, reactants, products, tol=1E-08):
+def simulate_products(bioiso_id, model, node, reactants, products, tol=1E-08, engine=None, expansion=None,
+                      compressed=None):
+    if expansion is not None and expansion.blocks(node, reactants, products):
+        return record_prefiltered(bioiso_id)
+
+    if compressed is not None:
+
+        if compressed.retains([node.id] + [metabolite.id for metabolite in reactants + products]):
+            model, engine = compressed.model, compressed.engine
+
+    if engine is not None:
+        return simulate_products_engine(bioiso_id, engine, node, reactants, products, tol)
+
     with model as m:
 
         for reactant in reactants:
@@ -357,9 +564,83 @@ def simulate_products(bioiso_id, model, node, reactants, products, tol=1E-08):
         # using fba, which is much much much faster than pFBA
         solution = m.optimize(objective_sense='minimize')
 
+        record_witness(bioiso_id, m)
+
     return evalSol(solution, tol)
 
 
+def simulate_reaction_engine(bioiso_id, engine, reaction, is_maximize, tol=1E-08):
+    """Same LP of simulate_reaction, but solved directly in the optlang problem by a SolverEngine"""
+
+    try:
+
+        solution = engine.optimize_reaction(reaction, is_maximize)
+
+        record_witness(bioiso_id, engine.model)
+
+        if is_maximize:
+            harvest_solution(bioiso_id, engine.model, engine.direction == 'max')
+
+        else:
+            # the engine only changes the bounds of the reaction variables
+            harvest_solution(bioiso_id, engine.model, engine.direction == 'max', reaction, reaction.bounds)
+
+    finally:
+        engine.reset()
+
+    return evalSlimSol(solution, tol)
+
+
+def simulate_reactants_engine(bioiso_id, engine, node, reactants, products, tol=1E-08):
+    """Same LP of simulate_reactants, but using the drains installed by a SolverEngine"""
+
+    try:
+
+        for product in products:
+            engine.open_drain(product.id, (-999999, 0))
+
+        for reactant in reactants:
+
+            if reactant.id != node.id:
+                engine.open_drain(reactant.id, (0, 999999))
+
+        drain_name = engine.open_drain(node.id, (0, 999999))
+
+        solution = engine.optimize(drain_name)
+
+        record_witness(bioiso_id, engine.model)
+
+    finally:
+        engine.reset()
+
+    return evalSlimSol(solution, tol)
+
+
+def simulate_products_engine(bioiso_id, engine, node, reactants, products, tol=1E-08):
+    """Same LP of simulate_products, but using the drains installed by a SolverEngine"""
+
+    try:
+
+        for reactant in reactants:
+            engine.open_drain(reactant.id, (0, 999999))
+
+        for product in products:
+
+            if product.id != node.id:
+                engine.open_drain(product.id, (-999999, 0))
+
+        drain_name = engine.open_drain(node.id, (-999999, 0))
+
+        solution = engine.optimize(drain_name, objective_sense='minimize')
+
+        record_witness(bioiso_id, engine.model)
+
+    finally:
+        engine.reset()
+
+    return evalSlimSol(solution, tol)
+
+
 def evalSol(solution, tol=1E-08):
     if np.isnan(solution.objective_value):
         return False
@@ -383,93 +664,168 @@ def evalSlimSol(solution, tol=1E-08):
     return True
 
 
-def singleReactionKO(model, reaction_id, objective_reaction, exchange_prefix=None, tol=1E-08):
-    set_objective_function(model, reaction_id)
+def reference_fluxes(model):
+    """Fluxes of a reference solution of the model objective, namely the pFBA solution, or the FBA solution if pFBA
+    fails (e.g. the optimum is too close to the tolerance of the solver)"""
 
-    initial_sol = model.optimize(objective_sense=objective_reaction)
+    try:
+        solution = pfba(model)
 
-    if not evalSol(initial_sol, tol):
-        raise ValueError("Objective value is zero. Model must have a valid solution objective value")
+    except OptimizationError:
+        solution = None
 
-    # exchange reactions to remove
-    if exchange_prefix is not None:
+    if solution is None or solution.status != 'optimal':
+        solution = model.optimize()
 
-        reactions_remove = [i.id for i in model.reactions if exchange_prefix in i.name]
+    return solution.fluxes
 
-    else:
 
-        reactions_remove = [i.id for i in model.reactions if 'Drainfor' in i.name or 'EX_' in i.id]
+def screen_knockouts(model, reactions_ids, tol=1E-08, max_lethal=None):
+    """Lethal single reaction KOs of the model objective among the given reactions, in the same order
+    Each KO toggles the bounds of the reaction on the warm solver of the model. The solution of a KO that is not
+    lethal is feasible in the KO of any other reaction without flux in it, whose optimum is then between the two, so
+    these KOs are skipped. This only holds if the bounds of the KO reaction allow zero flux and the optimum of the KO
+    has the sign of the optimum of the model. Only fluxes that are exactly zero are trusted, as the fluxes of a KO
+    with low growth can be below the tolerance.
+    If max_lethal is given, the screening stops as soon as that number of lethal KOs is found"""
 
-    for i in model.exchanges:
+    lethal = []
+    skip = set()
 
-        if i.id not in reactions_remove:
-            reactions_remove.append(i.id)
+    reference = model.slim_optimize()
 
-    reactions_remove.append(reaction_id)
+    variables = {reaction_id: (get_reaction(model, reaction_id).forward_variable.name,
+                               get_reaction(model, reaction_id).reverse_variable.name)
+                 for reaction_id in reactions_ids}
 
-    with model as m:
-        reac_list = [get_reaction(m, i.id) for i in m.reactions if i.id not in reactions_remove]
+    for reaction_id in reactions_ids:
 
-    solution = single_reaction_deletion(model, reaction_list=reac_list)
+        if reaction_id in skip:
+            continue
 
-    solution.iloc[:, 0] = list(map(lambda x: list(x)[0], solution.iloc[:, 0]))
+        reaction = get_reaction(model, reaction_id)
+        bounds = reaction.bounds
 
-    solution.loc[:, 'growth'][np.isnan(solution.loc[:, 'growth'])] = float(0)
-    solution.loc[:, 'growth'] = solution.loc[:, 'growth'].apply(lambda x: float(abs(x)))
+        reaction.bounds = (0.0, 0.0)
 
-    sr_lethal = solution[solution.loc[:, 'growth'] <= tol]
+        value = model.slim_optimize()
 
-    if sr_lethal.shape[0] == 0:
-        print(reaction_id, " failed", " since there is no KO available")
-        print(reaction_id, " trying exchange reactions")
+        if not evalSlimSol(value, tol):
+            lethal.append(reaction_id)
 
-        reactions_remove = [reaction_id]
+        elif bounds[0] <= 0 <= bounds[1] and value * reference > 0:
 
-        with model as m:
-            reac_list = [get_reaction(m, i.id) for i in m.reactions if i.id not in reactions_remove]
+            primals = model.solver.primal_values
+            skip.update(other_id for other_id, (forward, reverse) in variables.items()
+                        if primals[forward] == primals[reverse] == 0)
 
-        solution = single_reaction_deletion(model, reaction_list=reac_list)
+        reaction.bounds = bounds
 
-        solution.iloc[:, 0] = list(map(lambda x: list(x)[0], solution.iloc[:, 0]))
+        if max_lethal is not None and len(lethal) >= max_lethal:
+            break
 
-        solution.loc[:, 'growth'][np.isnan(solution.loc[:, 'growth'])] = float(0)
-        solution.loc[:, 'growth'] = solution.loc[:, 'growth'].apply(lambda x: float(abs(x)))
+    return lethal
 
-        sr_lethal = solution[solution.loc[:, 'growth'] <= tol]
 
-    if sr_lethal.shape[0] == 0:
-        raise ValueError("{} failed since there is no KO available".format(reaction_id))
+# model of the KO screening, which forked worker processes inherit copy-on-write
+_screen_model = None
+_screen_args = None
+
+
+def screen_knockouts_task(reactions_ids):
+    return screen_knockouts(_screen_model, reactions_ids, *_screen_args)
+
+
+def find_knockouts(model, reactions_ids, tol=1E-08, max_lethal=None, processes=1):
+    """Lethal single reaction KOs of the model objective among the given reactions (see screen_knockouts)
+    Reactions without flux in the reference solution of the model (see reference_fluxes) are not screened, as their
+    KO cannot be lethal. If processes is higher than 1, the remaining reactions are split between forked worker
+    processes, each screening its share on its own copy of the solver"""
+
+    global _screen_model, _screen_args
+
+    fluxes = reference_fluxes(model)
+
+    candidates = [reaction_id for reaction_id in reactions_ids if fluxes[reaction_id] != 0]
+
+    if processes <= 1 or len(candidates) < processes:
+        return screen_knockouts(model, candidates, tol, max_lethal)
+
+    _screen_model = model
+    _screen_args = (tol, max_lethal)
+
+    try:
+
+        with multiprocessing.get_context('fork').Pool(processes=processes) as pool:
+            shares = pool.map(screen_knockouts_task, [candidates[i::processes] for i in range(processes)])
+
+    finally:
+        _screen_model = None
+        _screen_args = None
+
+    # the shares are merged back in the order of the candidates, so that the first max_lethal are the serial ones
+    position = {reaction_id: i for i, reaction_id in enumerate(candidates)}
+
+    lethal = sorted((reaction_id for share in shares for reaction_id in share), key=position.get)
 
-    all_kos = list(sr_lethal.iloc[:, 0])
-    random.shuffle(all_kos)
+    if max_lethal is not None:
+        lethal = lethal[:max_lethal]
+
+    return lethal
+
+
+def singleReactionKO(model, reaction_id, objective_reaction, exchange_prefix=None, tol=1E-08, processes=1,
+                     max_lethal=None):
+    """Lethal single reaction KOs for the given reaction and objective, excluding exchange reactions unless there is
+    no other lethal KO. Return a sample of at most five lethal KOs and all lethal KOs found, in random order.
+    If max_lethal is given, the search stops as soon as that number of lethal KOs is found, which are then a random
+    sample of all lethal KOs. See find_knockouts for processes"""
+
+    set_objective_function(model, reaction_id)
+
+    initial_sol = model.optimize(objective_sense=objective_reaction)
+
+    if not evalSol(initial_sol, tol):
+        raise ValueError("Objective value is zero. Model must have a valid solution objective value")
+
+    # exchange reactions to remove
+    if exchange_prefix is not None:
+
+        reactions_remove = [i.id for i in model.reactions if exchange_prefix in i.name]
 
-    if len(all_kos) > 5:
-        # n_kos = math.ceil(len(all_kos) * 0.1)
-        n_kos = 5
     else:
-        n_kos = len(all_kos)
 
-    kos = []
+        reactions_remove = [i.id for i in model.reactions if 'Drainfor' in i.name or 'EX_' in i.id]
+
+    for i in model.exchanges:
 
-    for i in range(n_kos):
+        if i.id not in reactions_remove:
+            reactions_remove.append(i.id)
 
-        ko = all_kos[i]
+    # the candidates are shuffled, so that the lethal KOs found before an early stop are a random sample
+    reac_list = [i.id for i in model.reactions if i.id not in reactions_remove and i.id != reaction_id]
+    random.shuffle(reac_list)
 
-        with model as m:
+    with model as m:
+        set_objective_function(m, reaction_id)
+        m.objective_direction = objective_reaction
 
-            m.reactions.get_by_id(ko).bounds = (0.0, 0.0)
+        all_kos = find_knockouts(m, reac_list, tol, max_lethal, processes)
 
-            set_objective_function(m, reaction_id)
+        if len(all_kos) == 0:
+            print(reaction_id, " failed", " since there is no KO available")
+            print(reaction_id, " trying exchange reactions")
 
-            last_sol = m.optimize(objective_sense=objective_reaction)
+            # the other reactions were already screened
+            reac_list = [i for i in reactions_remove if i != reaction_id]
+            random.shuffle(reac_list)
 
-            if evalSol(last_sol, tol):
+            all_kos = find_knockouts(m, reac_list, tol, max_lethal, processes)
 
-                raise ValueError("{} failed since the KO {} is not lethal, "
-                                 "so cobrapy single reaction deletion solution is "
-                                 "somehow incorrect".format(reaction_id, ko))
+    if len(all_kos) == 0:
+        raise ValueError("{} failed since there is no KO available".format(reaction_id))
 
-            else:
-                kos.append(ko)
+    # the KOs were screened with the same LP, so the sample does not need to be solved again
+    kos = all_kos[:5]
 
     return kos, all_kos
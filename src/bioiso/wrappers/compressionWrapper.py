@@ -0,0 +1,131 @@
+from bioiso import BoundsFingerprint
+
+
+class CompressedModel:
+    """Reduced copy of a model, in which the LPs of Bioiso are solved whenever the reduction is exact for them
+    The blocked reactions and the dead-end metabolites, which carry no flux at steady state, are removed, so the LPs
+    of the metabolites and reactions left are the same in the copy (see retains). It is a snapshot of the model"""
+
+    def __init__(self, model):
+
+        self.state = BoundsFingerprint(model).state
+
+        # size of the LPs of the model, namely the rows, columns and coefficients of its stoichiometric matrix
+        self.original_size = self.size(model)
+
+        self.blocked_reactions, self.dead_end_metabolites = self.__reduce(model)
+
+        self.model = model.copy()
+        self.model.remove_reactions(sorted(self.blocked_reactions))
+        self.model.remove_metabolites([self.model.metabolites.get_by_id(metabolite_id)
+                                       for metabolite_id in sorted(self.dead_end_metabolites)])
+
+        self.metabolites_ids = {metabolite.id for metabolite in self.model.metabolites}
+        self.reactions_ids = {reaction.id for reaction in self.model.reactions}
+
+        # solver engine of the copy, which is opened and closed with the resources of a run (see BioISO.open_resources)
+        self.engine = None
+
+    @staticmethod
+    def __reduce(model):
+
+        """Blocked reactions and dead-end metabolites of the model
+        The metabolites of reactions whose bounds exclude zero are kept, as removing these reactions would make
+        infeasible LPs feasible"""
+
+        directions = {reaction.id: (reaction.upper_bound > 0, reaction.lower_bound < 0) for reaction in model.reactions}
+
+        blocked_reactions = {reaction_id for reaction_id, (forward, backward) in directions.items()
+                             if not forward and not backward}
+
+        kept = {metabolite.id for reaction in model.reactions if reaction.lower_bound > 0 or reaction.upper_bound < 0
+                for metabolite in reaction.metabolites}
+
+        # directions producing and consuming each metabolite
+        producers = {}
+        consumers = {}
+
+        for metabolite in model.metabolites:
+
+            producers[metabolite.id] = 0
+            consumers[metabolite.id] = 0
+
+            for reaction in metabolite.reactions:
+
+                if reaction.id in blocked_reactions:
+                    continue
+
+                forward, backward = directions[reaction.id]
+                coefficient = reaction.get_coefficient(metabolite.id)
+
+                producers[metabolite.id] += (coefficient > 0 and forward) + (coefficient < 0 and backward)
+                consumers[metabolite.id] += (coefficient < 0 and forward) + (coefficient > 0 and backward)
+
+        queue = [metabolite_id for metabolite_id in producers if metabolite_id not in kept and
+                 (not producers[metabolite_id] or not consumers[metabolite_id])]
+
+        dead_end_metabolites = set(queue)
+
+        while queue:
+
+            metabolite = model.metabolites.get_by_id(queue.pop())
+
+            for reaction in metabolite.reactions:
+
+                if reaction.id in blocked_reactions:
+                    continue
+
+                blocked_reactions.add(reaction.id)
+
+                forward, backward = directions[reaction.id]
+
+                for other, coefficient in reaction.metabolites.items():
+
+                    producers[other.id] -= (coefficient > 0 and forward) + (coefficient < 0 and backward)
+                    consumers[other.id] -= (coefficient < 0 and forward) + (coefficient > 0 and backward)
+
+                    if other.id in kept or other.id in dead_end_metabolites:
+                        continue
+
+                    if not producers[other.id] or not consumers[other.id]:
+                        dead_end_metabolites.add(other.id)
+                        queue.append(other.id)
+
+        return blocked_reactions, dead_end_metabolites
+
+    @staticmethod
+    def size(model):
+
+        """Rows, columns and coefficients of the stoichiometric matrix of a model"""
+
+        return {'metabolites': len(model.metabolites),
+                'reactions': len(model.reactions),
+                'coefficients': sum(len(reaction.metabolites) for reaction in model.reactions)}
+
+    def holds(self, model):
+
+        """Whether the copy is a reduction of the current state of the model, including its objective direction"""
+
+        return BoundsFingerprint(model).state == self.state
+
+    def retains(self, metabolites_ids=(), reaction_id=None):
+
+        """Whether the LP opening the drains of the given metabolites, and changing the bounds of the given reaction, if
+        any, can be solved in the copy"""
+
+        if reaction_id is not None and reaction_id not in self.reactions_ids:
+            return False
+
+        return all(metabolite_id in self.metabolites_ids for metabolite_id in metabolites_ids)
+
+    def is_blocked(self, reaction_id):
+
+        """Whether the reaction carries no flux in the maximize LPs of simulate_reaction, which are thus False"""
+
+        return reaction_id in self.blocked_reactions
+
+    def stats(self):
+
+        """Size of the LPs of the model and of the copy (see size)"""
+
+        return {'original': self.original_size, 'compressed': self.size(self.model)}
@@ -0,0 +1,349 @@
+from array import array
+import numpy as np
+
+# roles of the reactions of a metabolite (see StoichiometricIndex.roles)
+MAXIMIZE = 1
+MINIMIZE = 0
+UNKNOWN = -1
+
+
+class StoichiometricIndex:
+    """Sparse stoichiometric matrix of a model, together with the bounds of its reactions, in NumPy arrays
+
+    The matrix is kept both by reaction (CSR, namely the metabolites of each reaction) and by metabolite (CSC, namely
+    the reactions of each metabolite), in the order of model.reactions and model.metabolites. The reactants and
+    products of each reaction are listed once, so that the reaction records of get_reactions_by_role share them.
+    The index is a snapshot of the model, so it must be built again whenever the bounds or reactions change"""
+
+    def __init__(self, model):
+
+        self.reactions = list(model.reactions)
+        self.metabolites = list(model.metabolites)
+
+        self.reactions_positions = {reaction.id: position for position, reaction in enumerate(self.reactions)}
+        self.metabolites_positions = {metabolite.id: position for position, metabolite in enumerate(self.metabolites)}
+
+        self.lower_bounds = np.array([reaction.lower_bound for reaction in self.reactions], dtype=float)
+        self.upper_bounds = np.array([reaction.upper_bound for reaction in self.reactions], dtype=float)
+
+        self.reactants = []
+        self.products = []
+        self.reactants_ids = []
+        self.products_ids = []
+
+        reactions_indptr = [0]
+        metabolites_indices = []
+        coefficients = []
+
+        for reaction in self.reactions:
+
+            for metabolite, coefficient in reaction.metabolites.items():
+                metabolites_indices.append(self.metabolites_positions[metabolite.id])
+                coefficients.append(coefficient)
+
+            reactions_indptr.append(len(metabolites_indices))
+
+            reactants = reaction.reactants
+            products = reaction.products
+
+            self.reactants.append(reactants)
+            self.products.append(products)
+            self.reactants_ids.append([reactant.id for reactant in reactants])
+            self.products_ids.append([product.id for product in products])
+
+        # by reaction (CSR)
+        self.reactions_indptr = np.array(reactions_indptr, dtype=np.int64)
+        self.metabolites_indices = np.array(metabolites_indices, dtype=np.int64)
+        self.coefficients = np.array(coefficients, dtype=float)
+
+        # by metabolite (CSC), the reactions of each metabolite being sorted as in model.reactions
+        reactions_indices = np.repeat(np.arange(len(self.reactions), dtype=np.int64), np.diff(self.reactions_indptr))
+        order = np.argsort(self.metabolites_indices, kind='stable')
+
+        self.metabolites_indptr = np.zeros(len(self.metabolites) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.metabolites_indices, minlength=len(self.metabolites)),
+                  out=self.metabolites_indptr[1:])
+
+        self.reactions_indices = reactions_indices[order]
+        self.metabolites_coefficients = self.coefficients[order]
+
+    def column(self, metabolite_id):
+
+        """Positions and stoichiometric coefficients of the reactions of a metabolite"""
+
+        position = self.metabolites_positions[metabolite_id]
+
+        start, end = self.metabolites_indptr[position], self.metabolites_indptr[position + 1]
+
+        return self.reactions_indices[start:end], self.metabolites_coefficients[start:end]
+
+    def get_reactions(self, metabolite_id):
+
+        reactions_indices, _ = self.column(metabolite_id)
+
+        return [self.reactions[position] for position in reactions_indices.tolist()]
+
+    def roles(self, metabolite_id, isReactant):
+
+        """Vectorized isMaximize for all reactions of a metabolite
+        It returns the positions of the reactions and their roles, namely MAXIMIZE (True), MINIMIZE (False) or
+        UNKNOWN (None)"""
+
+        reactions_indices, coefficients = self.column(metabolite_id)
+
+        lower_bounds = self.lower_bounds[reactions_indices]
+        upper_bounds = self.upper_bounds[reactions_indices]
+
+        # the metabolite is a product of the reaction if it is a reactant in the tree, and vice-versa
+        if isReactant:
+            wanted, opposite = coefficients > 0, coefficients < 0
+        else:
+            wanted, opposite = coefficients < 0, coefficients > 0
+
+        reversible = (upper_bounds > 0) & (lower_bounds < 0)
+        forward = (upper_bounds > 0) & ~reversible
+        backward = (upper_bounds <= 0) & (lower_bounds < 0)
+
+        roles = np.full(len(reactions_indices), UNKNOWN, dtype=np.int8)
+
+        roles[reversible] = MINIMIZE
+        roles[(reversible | forward) & wanted] = MAXIMIZE
+        roles[backward & opposite] = MINIMIZE
+
+        return reactions_indices, roles
+
+
+class NetworkExpansion:
+    """Topological producibility and consumability of the metabolites of a StoichiometricIndex
+    The producible metabolites are the largest set in which every metabolite has a producing direction whose inputs
+    are all in the set, seeded by the directions without inputs and by the drains of an LP, so a metabolite outside
+    it is unproducible in any LP. The consumable ones are found likewise, with inputs and outputs swapped"""
+
+    def __init__(self, index):
+
+        self.index = index
+
+        inputs = []
+        outputs = []
+
+        for position in range(len(index.reactions)):
+
+            start, end = index.reactions_indptr[position], index.reactions_indptr[position + 1]
+
+            metabolites = index.metabolites_indices[start:end]
+            coefficients = index.coefficients[start:end]
+
+            reactants = metabolites[coefficients < 0].tolist()
+            products = metabolites[coefficients > 0].tolist()
+
+            if index.upper_bounds[position] > 0:
+                inputs.append(reactants)
+                outputs.append(products)
+
+            if index.lower_bounds[position] < 0:
+                inputs.append(products)
+                outputs.append(reactants)
+
+        self.inputs = inputs
+        self.outputs = outputs
+
+        # directions by input and by output of each metabolite
+        self.consumers = [[] for _ in index.metabolites]
+        self.producers = [[] for _ in index.metabolites]
+
+        for direction, (direction_inputs, direction_outputs) in enumerate(zip(inputs, outputs)):
+
+            for metabolite in direction_inputs:
+                self.consumers[metabolite].append(direction)
+
+            for metabolite in direction_outputs:
+                self.producers[metabolite].append(direction)
+
+        self.sweeps = {}
+
+        self.base_producible = self.sweep(True)
+        self.base_consumable = self.sweep(False)
+
+    def sweep(self, produce, seeds=()):
+
+        """Metabolites that may be produced (or consumed) when the seeds are supplied (or drained), as a boolean array
+        A direction is pruned once one of its inputs (or outputs) is pruned, and a metabolite once no direction
+        producing (or consuming) it is left"""
+
+        if produce:
+            needed, given, by_needed, by_given = self.inputs, self.outputs, self.consumers, self.producers
+
+        else:
+            needed, given, by_needed, by_given = self.outputs, self.inputs, self.producers, self.consumers
+
+        alive = np.ones(len(self.index.metabolites), dtype=bool)
+        directions_alive = np.ones(len(needed), dtype=bool)
+        counts = [len(directions) for directions in by_given]
+
+        seeded = np.zeros(len(self.index.metabolites), dtype=bool)
+        seeded[list(seeds)] = True
+
+        queue = [metabolite for metabolite, count in enumerate(counts) if count == 0 and not seeded[metabolite]]
+        alive[queue] = False
+
+        while queue:
+
+            metabolite = queue.pop()
+
+            for direction in by_needed[metabolite]:
+
+                if not directions_alive[direction]:
+                    continue
+
+                directions_alive[direction] = False
+
+                for other in given[direction]:
+
+                    counts[other] -= 1
+
+                    if counts[other] == 0 and alive[other] and not seeded[other]:
+                        alive[other] = False
+                        queue.append(other)
+
+        return alive
+
+    def __check(self, produce, metabolite_id, seeds_ids):
+
+        position = self.index.metabolites_positions[metabolite_id]
+
+        base = self.base_producible if produce else self.base_consumable
+
+        # seeds only add metabolites to the sweep
+        if base[position]:
+            return True
+
+        seeds = frozenset(self.index.metabolites_positions[seed_id] for seed_id in seeds_ids)
+
+        if not seeds:
+            return False
+
+        key = (produce, seeds)
+
+        alive = self.sweeps.get(key)
+
+        if alive is None:
+            alive = self.sweep(produce, seeds)
+            self.sweeps[key] = alive
+
+        return bool(alive[position])
+
+    def producible(self, metabolite_id, supplied_ids=()):
+
+        """Whether the metabolite may be produced when the given metabolites are supplied (see simulate_reactants)"""
+
+        return self.__check(True, metabolite_id, supplied_ids)
+
+    def consumable(self, metabolite_id, drained_ids=()):
+
+        """Whether the metabolite may be consumed when the given metabolites are drained (see simulate_products)"""
+
+        return self.__check(False, metabolite_id, drained_ids)
+
+    def blocks(self, node, reactants, products):
+
+        """Whether the LP of a node is infeasible, namely its metabolite cannot be produced with the products of the
+        reaction supplied, if it is a reactant, or consumed with the reactants drained, if it is a product"""
+
+        if node.is_reactant:
+            return not self.producible(node.id, [product.id for product in products])
+
+        return not self.consumable(node.id, [reactant.id for reactant in reactants])
+
+
+# flux of a reaction record, coded by its position
+RECORD_FLUXES = (False, True, 'unknown')
+
+
+class ReactionRecord:
+    """Reaction of a reactions_list built with a StoichiometricIndex
+    It behaves as the (reaction, reaction id, flux, ids, ids, metabolites, metabolites) tuples of
+    get_reactions_by_role, where the reactants come first if forward is True, and the products otherwise.
+    The cobra objects are only resolved from the index when they are indexed"""
+
+    __slots__ = ('index', 'position', 'flux', 'forward')
+
+    def __init__(self, index, position, flux, forward=True):
+        self.index = index
+        self.position = position
+        self.flux = flux
+        self.forward = forward
+
+    def __getitem__(self, item):
+
+        if item < 0:
+            item += 7
+
+        if item == 0:
+            return self.index.reactions[self.position]
+
+        if item == 1:
+            return self.index.reactions[self.position].id
+
+        if item == 2:
+            return self.flux
+
+        if item in (3, 4):
+
+            if (item == 3) == self.forward:
+                return self.index.reactants_ids[self.position]
+
+            return self.index.products_ids[self.position]
+
+        if item in (5, 6):
+
+            if (item == 5) == self.forward:
+                return self.index.reactants[self.position]
+
+            return self.index.products[self.position]
+
+        raise IndexError('reaction record index out of range')
+
+    def __len__(self):
+        return 7
+
+    def __iter__(self):
+        return (self[item] for item in range(7))
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+class ReactionRecords:
+    """Compact reactions_list of a node, namely the positions of the reactions in a StoichiometricIndex and a code
+    per reaction with its flux and direction. It behaves as a list of ReactionRecord, which are created on access"""
+
+    __slots__ = ('index', 'positions', 'codes')
+
+    def __init__(self, index, records=()):
+        self.index = index
+        self.positions = array('i')
+        self.codes = array('b')
+
+        for position, flux, forward in records:
+            self.positions.append(position)
+            self.codes.append(RECORD_FLUXES.index(flux) * 2 + bool(forward))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, item):
+
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+
+        code = self.codes[item]
+
+        return ReactionRecord(self.index, self.positions[item], RECORD_FLUXES[code // 2], bool(code % 2))
+
+    def __iter__(self):
+
+        for position, code in zip(self.positions, self.codes):
+            yield ReactionRecord(self.index, position, RECORD_FLUXES[code // 2], bool(code % 2))
+
+    def __repr__(self):
+        return repr(list(self))
@@ -0,0 +1,63 @@
+import multiprocessing
+
+from bioiso import Node
+from bioiso.wrappers.cobraWrapper import get_reaction, get_metabolite, simulate_reaction, simulate_reactants, \
+    simulate_products
+from bioiso.wrappers.solverWrapper import SolverEngine
+
+# each worker process holds its own copy of the model (and of the compressed model, if any), and its own drains if the
+# solver engine is used
+_worker_model = None
+_worker_engine = None
+_worker_compressed = None
+
+
+def init_worker(model, engine='cobra', compressed=None):
+    global _worker_model, _worker_engine, _worker_compressed
+    _worker_model = model
+    _worker_compressed = compressed
+
+    if engine == 'solver':
+        _worker_engine = SolverEngine(model)
+
+        if compressed is not None:
+            compressed.engine = SolverEngine(compressed.model)
+
+
+def evaluate_task(task):
+    """Solves the LP described by a task in the worker model
+    Tasks only carry identifiers, namely ('simulate_reaction', reaction_id, is_maximize) or
+    ('simulate_reactants' | 'simulate_products', metabolite_id, reactants_ids, products_ids)"""
+
+    name = task[0]
+
+    if name == 'simulate_reaction':
+
+        reaction = get_reaction(_worker_model, task[1])
+
+        # the undecorated function is called, as the node cache lives in the main process
+        return simulate_reaction.function(None, _worker_model, reaction, task[2], engine=_worker_engine,
+                                          compressed=_worker_compressed)
+
+    node = Node(identifier=task[1])
+    reactants = [get_metabolite(_worker_model, metabolite_id) for metabolite_id in task[2]]
+    products = [get_metabolite(_worker_model, metabolite_id) for metabolite_id in task[3]]
+
+    if name == 'simulate_reactants':
+        return simulate_reactants.function(None, _worker_model, node, reactants, products, engine=_worker_engine,
+                                           compressed=_worker_compressed)
+
+    return simulate_products.function(None, _worker_model, node, reactants, products, engine=_worker_engine,
+                                      compressed=_worker_compressed)
+
+
+def new_pool(model, workers, engine='cobra', compressed=None):
+    return multiprocessing.Pool(processes=workers, initializer=init_worker, initargs=(model, engine, compressed))
+
+
+def evaluate_tasks(pool, tasks, workers):
+    """Dispatches the tasks to the pool, returning the analysis of each task in the same order"""
+
+    chunksize = max(1, len(tasks) // (workers * 4))
+
+    return pool.map(evaluate_task, tasks, chunksize=chunksize)
@@ -0,0 +1,193 @@
+from optlang.interface import OPTIMAL
+from optlang.symbolics import Zero
+import numpy as np
+
+from bioiso.wrappers.cobraWrapper import get_reaction, has_reaction
+
+
+class SolverEngine:
+    """Evaluates the nodes and reactions of a Bioiso tree directly in the optlang problem of the model
+    Closed drains are installed up front for each metabolite as solver variables, and each LP only opens the drains
+    and changes the bounds it needs, which reset restores without cobra model contexts. remove uninstalls them"""
+
+    def __init__(self, model):
+
+        self.model = model
+        self.drains = {}
+        self.opened = {}
+
+        # bounds of the variables changed by the last LP
+        self.changed = []
+
+        self.__objective = model.solver.objective.expression
+        self.__direction = model.solver.objective.direction
+
+        # objective of the engine, whose linear coefficients are set for each LP
+        self.__engine_objective = None
+        self.__coefficients = {}
+
+        interface = model.problem
+
+        for metabolite in model.metabolites:
+
+            for prefix in ('Demand_', 'Sink_'):
+
+                drain_name = prefix + metabolite.id
+
+                if not has_reaction(model, drain_name):
+                    self.drains[drain_name] = interface.Variable('bioiso_' + drain_name, lb=0, ub=0)
+
+        model.solver.add(list(self.drains.values()))
+        model.solver.update()
+
+        for metabolite in model.metabolites:
+
+            coefficients = {self.drains[prefix + metabolite.id]: -1 for prefix in ('Demand_', 'Sink_')
+                            if prefix + metabolite.id in self.drains}
+
+            if coefficients:
+                model.solver.constraints[metabolite.id].set_linear_coefficients(coefficients)
+
+    def open_drain(self, metabolite_id, bounds=(-999999, 999999)):
+
+        """Opens the drain of a metabolite, returning its name
+        As in create_unbalenced_reaction, it is a Demand_ drain if the lower bound is not negative,
+        and a Sink_ drain otherwise"""
+
+        if bounds[0] >= 0.0:
+            drain_name = "Demand_" + metabolite_id
+        else:
+            drain_name = "Sink_" + metabolite_id
+
+        variable = self.drains.get(drain_name)
+
+        if variable is not None and drain_name not in self.opened:
+            variable.set_bounds(bounds[0], bounds[1])
+            self.opened[drain_name] = variable
+
+        return drain_name
+
+    @property
+    def direction(self):
+
+        """Direction of the model objective, in which the maximize LPs of simulate_reaction are solved"""
+
+        return self.__direction
+
+    def set_bounds(self, variable, lower_bound, upper_bound):
+
+        """Changes the bounds of a variable until the next reset"""
+
+        self.changed.append((variable, variable.lb, variable.ub))
+        variable.set_bounds(lower_bound, upper_bound)
+
+    def reset(self):
+
+        """Closes the drains opened and restores the bounds changed since the last call, as well as the direction of
+        the model objective"""
+
+        for variable in self.opened.values():
+            variable.set_bounds(0, 0)
+
+        self.opened = {}
+
+        for variable, lower_bound, upper_bound in reversed(self.changed):
+            variable.set_bounds(lower_bound, upper_bound)
+
+        self.changed = []
+
+        self.model.solver.objective.direction = self.__direction
+
+    def set_objective(self, coefficients, direction):
+
+        """Sets the linear coefficients of the engine objective, the ones of the previous LP being set to zero.
+        The engine objective is installed again whenever the model objective was replaced (e.g. by cobra)"""
+
+        objective = self.model.solver.objective
+
+        if objective is not self.__engine_objective:
+
+            objective = self.model.problem.Objective(Zero, direction=direction)
+            self.model.solver.objective = objective
+
+            self.__engine_objective = self.model.solver.objective
+
+        else:
+
+            objective.set_linear_coefficients({variable: 0 for variable in self.__coefficients
+                                               if variable not in coefficients})
+            objective.direction = direction
+
+        objective.set_linear_coefficients(coefficients)
+        self.__coefficients = coefficients
+
+    def solve(self, coefficients, direction):
+
+        """Like cobra slim_optimize, it returns the objective value or nan if the LP is not optimal"""
+
+        self.set_objective(coefficients, direction)
+
+        self.model.solver.optimize()
+
+        if self.model.solver.status == OPTIMAL:
+            return self.model.solver.objective.value
+
+        return np.nan
+
+    def optimize(self, drain_name, objective_sense=None):
+
+        """Solves the LP using the flux of the drain as objective, in the direction of the model objective
+        unless objective_sense is given"""
+
+        direction = self.__direction
+
+        if objective_sense is not None:
+            direction = {'maximize': 'max', 'minimize': 'min'}[objective_sense]
+
+        return self.solve(self.drain_coefficients(drain_name), direction)
+
+    def drain_coefficients(self, drain_name):
+
+        """Linear coefficients of the flux of a drain, which is either installed by the engine or a model reaction"""
+
+        variable = self.drains.get(drain_name)
+
+        if variable is not None:
+            return {variable: 1}
+
+        reaction = get_reaction(self.model, drain_name)
+
+        return {reaction.forward_variable: 1, reaction.reverse_variable: -1}
+
+    def optimize_reaction(self, reaction, is_maximize):
+
+        """Solves the LP of simulate_reaction using the flux of the reaction as objective
+        If is_maximize, the LP is solved in the direction of the model objective (see harvest_solution).
+        Otherwise, the reaction bounds are set to (-999999, 0) as cobra does, namely the forward variable is
+        closed and the reverse one is set to (0, 999999), and the flux is minimized"""
+
+        coefficients = {reaction.forward_variable: 1, reaction.reverse_variable: -1}
+
+        if is_maximize:
+            return self.solve(coefficients, self.__direction)
+
+        self.set_bounds(reaction.forward_variable, 0, 0)
+        self.set_bounds(reaction.reverse_variable, 0, 999999)
+
+        return self.solve(coefficients, 'min')
+
+    def remove(self):
+
+        """Removes the drains from the model solver and restores the model objective"""
+
+        self.reset()
+
+        self.model.solver.objective = self.model.problem.Objective(self.__objective, direction=self.__direction,
+                                                                   sloppy=True)
+        self.__engine_objective = None
+        self.__coefficients = {}
+
+        self.model.solver.remove(list(self.drains.values()))
+        self.model.solver.update()
+
+        self.drains = {}
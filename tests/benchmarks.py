@@ -0,0 +1,215 @@
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+import warnings
+
+from validation import biomass_model_processing
+from bioiso import BioISO, load, set_solver, simulate_reaction, SolverEngine, CompressedModel
+
+warnings.filterwarnings("ignore")
+
+
+def benchmark_simulate_reaction(model, n_reactions=200, seed=0):
+    """Per-call time of simulate_reaction, using cobra (model contexts) and a SolverEngine (optlang problem),
+    for a sample of reactions of the model in both directions. The undecorated function is called,
+    so that the node cache does not hide the LPs"""
+
+    random.seed(seed)
+
+    reactions = random.sample(list(model.reactions), min(n_reactions, len(model.reactions)))
+
+    calls = [(reaction, is_maximize) for reaction in reactions for is_maximize in (True, False)]
+
+    start = time.time()
+    cobra_results = [simulate_reaction.function(None, model, reaction, is_maximize)
+                     for reaction, is_maximize in calls]
+    cobra_time = (time.time() - start) / len(calls)
+
+    engine = SolverEngine(model)
+
+    try:
+
+        start = time.time()
+        engine_results = [simulate_reaction.function(None, model, reaction, is_maximize, engine=engine)
+                          for reaction, is_maximize in calls]
+        engine_time = (time.time() - start) / len(calls)
+
+    finally:
+        engine.remove()
+
+    mismatches = sum(1 for cobra_result, engine_result in zip(cobra_results, engine_results)
+                     if cobra_result != engine_result)
+
+    return {'calls': len(calls),
+            'cobra (ms/call)': cobra_time * 1000,
+            'engine (ms/call)': engine_time * 1000,
+            'speedup': cobra_time / engine_time,
+            'mismatches': mismatches}
+
+
+def benchmark_compression(model, n_reactions=200, seed=0):
+    """Sizes of the model and of its CompressedModel, and per-call time of simulate_reaction in both, for a sample
+    of the reactions kept by the compression in both directions. The undecorated function is called, as above"""
+
+    start = time.time()
+    compressed = CompressedModel(model)
+    compression_time = time.time() - start
+
+    random.seed(seed)
+
+    reactions_ids = random.sample(sorted(compressed.reactions_ids), min(n_reactions, len(compressed.reactions_ids)))
+
+    calls = [(reaction_id, is_maximize) for reaction_id in reactions_ids for is_maximize in (True, False)]
+
+    times = []
+    results = []
+
+    for lp_model in (model, compressed.model):
+
+        start = time.time()
+        results.append([simulate_reaction.function(None, lp_model, lp_model.reactions.get_by_id(reaction_id),
+                                                   is_maximize)
+                        for reaction_id, is_maximize in calls])
+        times.append((time.time() - start) / len(calls))
+
+    mismatches = sum(1 for result, compressed_result in zip(*results) if result != compressed_result)
+
+    stats = compressed.stats()
+
+    return {'calls': len(calls),
+            'compression (s)': compression_time,
+            'original size': stats['original'],
+            'compressed size': stats['compressed'],
+            'original (ms/call)': times[0] * 1000,
+            'compressed (ms/call)': times[1] * 1000,
+            'speedup': times[0] / times[1],
+            'mismatches': mismatches}
+
+
+def current_rss():
+    """Current resident set size (KB), read from /proc on Linux"""
+
+    with open('/proc/self/status') as file:
+
+        for line in file:
+
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def tree_size(root):
+    """Number of nodes and size (bytes) of the objects held by the nodes of a tree, namely the nodes, their lists and
+    reaction records (including the lists of identifiers within), each object being counted once.
+    Cobra objects are not counted, as they belong to the model"""
+
+    seen = set()
+    size = 0
+    nodes = 0
+
+    def add(obj):
+        nonlocal size
+
+        if id(obj) in seen:
+            return False
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        return True
+
+    frontier = [root]
+
+    while frontier:
+        node = frontier.pop()
+
+        if not add(node):
+            continue
+
+        nodes += 1
+
+        add(node.next)
+        add(node.previous)
+
+        for reactions_list in (node.reactions_list, node.other_reactions_list):
+
+            if not add(reactions_list):
+                continue
+
+            if hasattr(reactions_list, 'positions'):
+                add(reactions_list.positions)
+                add(reactions_list.codes)
+                continue
+
+            for record in reactions_list:
+
+                if add(record):
+
+                    for item in record[3:5]:
+                        add(item)
+
+        frontier.extend(node.next)
+
+    return nodes, size
+
+
+def tree_memory(model, reaction_id, objective, level, engine, queue):
+    start_rss = current_rss()
+
+    start = time.time()
+
+    bio = BioISO(reaction_id, model, objective, time_out=None)
+    bio.run(level, engine=engine)
+
+    nodes, size = tree_size(bio.root)
+
+    queue.put({'level': level,
+               'nodes': nodes,
+               'tree size (MB)': size / 1024 ** 2,
+               'time (s)': time.time() - start,
+               'start RSS (MB)': start_rss / 1024,
+               'peak RSS (MB)': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               'tree RSS (MB)': (current_rss() - start_rss) / 1024})
+
+
+def benchmark_tree_memory(model, reaction_id, objective, level=3, engine='solver'):
+    """Peak and retained RSS of a Bioiso run, measured in a new process so that previous runs do not count"""
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+
+    process = context.Process(target=tree_memory, args=(model, reaction_id, objective, level, engine, queue))
+    process.start()
+
+    results = queue.get()
+    process.join()
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else 'simulate_reaction'
+
+    model_name = sys.argv[2] if len(sys.argv) > 2 else 'iJO1366'
+    model_path = os.getcwd() + '/models/' + model_name + '.xml'
+
+    model = load(model_path)
+
+    set_solver(model, 'cplex')
+
+    (reaction_id, growth), m, reactions, metabolites = biomass_model_processing[model_name](model)
+
+    if benchmark == 'simulate_reaction':
+        results = benchmark_simulate_reaction(m)
+
+    elif benchmark == 'compression':
+        results = benchmark_compression(m)
+
+    else:
+        level = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+        results = benchmark_tree_memory(m, reaction_id, 'maximize', level=level)
+
+    for key, value in results.items():
+        print('%s: %s' % (key, value))
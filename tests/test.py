@@ -1,30 +1,69 @@
+import gc
+import json
 import os
 import time
-from unittest import TestCase, TestLoader, TextTestRunner
+from importlib.util import find_spec
+from unittest import TestCase, TestLoader, TextTestRunner, skipIf
+
+import pandas as pd
+
+from cobra import Model, Metabolite, Reaction
+from cobra.flux_analysis import single_reaction_deletion
 
 from tests.validation import biomass_model_processing
-from bioiso import BioISO
-from bioiso import load, set_solver
+from bioiso import BioISO, FluxCapabilities, CompressedModel, NodeCache, StoichiometricIndex
+from bioiso import load, set_solver, get_reaction, get_reactions_roles, load_results, load_frames, searchSpaceSize, \
+    bioisosearchSpaceSize
+from bioiso import scan_knockouts, scan_index_name, find_knockouts, set_objective_function
+
+
+def normalize_tree(tree):
+    # the reactions of a metabolite are a frozenset in COBRApy, so their order may change between runs
+
+    return {key: dict(values,
+                      reactions=sorted(map(str, values['reactions'])),
+                      other_reactions=sorted(map(str, values['other_reactions'])),
+                      next=normalize_tree(values['next']))
+            for key, values in tree.items()}
 
 
 class TestBioISO(TestCase):
+    model_name = 'iDS372'
+    reaction_to_eval = 'Biomass_assembly_C3_cytop'
+    objective = 'maximize'
+    solver = 'cplex'
+    level = 2
+    fast = False
 
-    def setUp(self):
-        self.startTime = time.time()
+    @classmethod
+    def load_model(cls):
 
-        self.model_name = 'iDS372'
-        model_path = os.getcwd() + '/models/' + self.model_name + '.xml'
-        self.reaction_to_eval = 'Biomass_assembly_C3_cytop'
-        self.objective = 'maximize'
-        solver = 'cplex'
-        self.level = 2
-        self.fast = False
+        model = load(os.getcwd() + '/models/' + cls.model_name + '.xml')
 
-        model = load(model_path)
+        set_solver(model, cls.solver)
 
-        set_solver(model, solver)
+        growth, m, reactions, metabolites = biomass_model_processing[cls.model_name](model)
 
-        growth, self.m, reactions, metabolites = biomass_model_processing[self.model_name](model)
+        # tests comparing trees of different runs need the solver noise to be below the tolerance of the analysis
+        m.solver.configuration.tolerances.feasibility = 1E-09
+
+        return growth, m, reactions, metabolites
+
+    @classmethod
+    def setUpClass(cls):
+
+        # the baseline run, with the default options, against which each test compares its own variant
+        _, model, _, _ = cls.load_model()
+
+        cls.bio = BioISO(cls.reaction_to_eval, model, cls.objective)
+        cls.bio.run(cls.level, cls.fast)
+
+        cls.tree = normalize_tree(cls.bio.get_tree())
+
+    def setUp(self):
+        self.startTime = time.time()
+
+        growth, self.m, reactions, metabolites = self.load_model()
 
         self.presults = os.getcwd() + '/test_results/'
 
@@ -44,13 +83,514 @@ class TestBioISO(TestCase):
         self.startTime = time.time()
 
         # # one Bioiso instance for each evaluation
-        bio = BioISO(self.reaction_to_eval, self.m, self.objective)
-        bio.run(self.level, self.fast)
+        bio = self.bio
 
-        # # bio.write_results performs the get_tree and writes the results
+        # # bio.write_results streams the results of the tree, without building them with get_tree
         bio.write_results(self.presults + 'BioISOResults' + self.model_name + self.reaction_to_eval + '.json')
 
-        assert bio.results['M_root_M_root_M_root_product']['analysis']
+        assert bio.get_tree()['M_root_M_root_M_root_product']['analysis']
+
+    def test_BioISO_workers(self):
+        self.startTime = time.time()
+
+        parallel_bio = BioISO(self.reaction_to_eval, self.m, self.objective)
+        parallel_bio.run(self.level, self.fast, workers=2)
+
+        assert self.tree == normalize_tree(parallel_bio.get_tree())
+
+    def test_BioISO_solver_engine(self):
+        self.startTime = time.time()
+
+        solver_bio = BioISO(self.reaction_to_eval, self.m, self.objective)
+        solver_bio.run(self.level, self.fast, engine='solver')
+
+        assert self.tree == normalize_tree(solver_bio.get_tree())
+
+    def test_BioISO_stream(self):
+        self.startTime = time.time()
+
+        results_f_name = self.presults + 'BioISOResults' + self.model_name + self.reaction_to_eval
+
+        self.bio.write_results(results_f_name + '.json')
+
+        # the tree is written while populated depth-first, and it is not kept
+        stream_bio = BioISO(self.reaction_to_eval, self.m, self.objective)
+        stream_bio.run(self.level, self.fast, results_f_name=results_f_name + '_stream.json')
+
+        assert not stream_bio.root.next
+
+        with open(results_f_name + '.json') as file, open(results_f_name + '_stream.json') as stream_file:
+            assert normalize_tree(json.load(file)) == normalize_tree(json.load(stream_file))
+
+        # the results of the streamed tree can only be read from its file
+        with self.assertRaises(ValueError):
+            stream_bio.get_tree()
+
+        with self.assertRaises(ValueError):
+            stream_bio.to_frame()
+
+        with self.assertRaises(ValueError):
+            stream_bio.write_results(results_f_name + '_rewrite.json')
+
+    def test_BioISO_npz(self):
+        self.startTime = time.time()
+
+        results_f_name = self.presults + 'BioISOResults' + self.model_name + self.reaction_to_eval + '.npz'
+
+        self.bio.write_results(results_f_name, format='npz')
+
+        # the reactions of the results are tuples, which are loaded as lists
+        tree = json.loads(json.dumps(self.bio.get_tree()))
+
+        assert load_results(results_f_name) == tree
+
+        view = load_results(results_f_name, lazy=True)
+        root = 'M_root_M_root_M_root_product'
+
+        assert list(view[root]['next']) == list(tree[root]['next'])
+        assert view[root]['reactions'] == tree[root]['reactions']
+
+    def test_BioISO_frame(self):
+        self.startTime = time.time()
+
+        bio = self.bio
+
+        nodes, reactions = bio.to_frame()
+
+        assert nodes['parent_id'].iloc[0] == -1 and nodes['depth'].max() == self.level
+
+        reactions = reactions[~reactions['other']]
+
+        total_reactions, total_metabolites = searchSpaceSize(bio.get_tree())
+        bioiso_reactions, bioiso_metabolites = bioisosearchSpaceSize(bio.get_tree())
+
+        assert total_reactions == reactions['reaction'].nunique() + 1
+        assert total_metabolites == nodes['metabolite'].nunique() - 1
+
+        # the search space is also counted while the tree is populated
+        assert bio.stats == {'total reactions': total_reactions,
+                             'total metabolites': total_metabolites,
+                             'bioiso reactions': bioiso_reactions,
+                             'bioiso metabolites': bioiso_metabolites}
+
+    @skipIf(find_spec('pyarrow') is None, 'pyarrow is not installed')
+    def test_BioISO_frame_parquet(self):
+        self.startTime = time.time()
+
+        results_f_name = self.presults + 'BioISOResults' + self.model_name + self.reaction_to_eval
+
+        self.bio.write_results(results_f_name + '.npz', format='npz')
+        self.bio.write_frames(results_f_name + '_nodes.parquet', results_f_name + '_reactions.parquet')
+
+        nodes, reactions = self.bio.to_frame()
+
+        parquet_nodes = pd.read_parquet(results_f_name + '_nodes.parquet')
+        parquet_reactions = pd.read_parquet(results_f_name + '_reactions.parquet')
+
+        # the reactants and products are read from Parquet as arrays
+        for frame in (reactions, parquet_reactions):
+            for column in ('reactants', 'products'):
+                frame[column] = frame[column].map(list)
+
+        pd.testing.assert_frame_equal(nodes, parquet_nodes)
+        pd.testing.assert_frame_equal(reactions, parquet_reactions)
+
+        # and so are the frames of the npz results
+        npz_nodes, npz_reactions = load_frames(results_f_name + '.npz')
+
+        for column in ('reactants', 'products'):
+            npz_reactions[column] = npz_reactions[column].map(list)
+
+        pd.testing.assert_frame_equal(npz_nodes, parquet_nodes)
+        pd.testing.assert_frame_equal(npz_reactions, parquet_reactions)
+
+    def test_BioISO_run_many(self):
+        self.startTime = time.time()
+
+        targets = [(self.reaction_to_eval, self.objective), ('Protein_cytop', 'maximize')]
+
+        many = BioISO.run_many(self.m, targets, self.level, fast=self.fast)
+
+        assert [many_bio.reaction_id for many_bio in many] == [target[0] for target in targets]
+        assert self.tree == normalize_tree(many[0].get_tree())
+
+        # the precursors of the protein were already evaluated for the biomass
+        assert many[1].cache_stats['hits'] > many[1].cache_stats['misses']
+
+    def test_BioISO_failures(self):
+        self.startTime = time.time()
+
+        with self.m as m:
+            # lethal KO
+            get_reaction(m, 'R00104_C3_cytop').bounds = (0.0, 0.0)
+
+            bio = BioISO(self.reaction_to_eval, m, self.objective)
+            bio.run(self.level, self.fast, strategy='failures')
+
+        tree = bio.get_tree()
+        root = tree['M_root_M_root_M_root_product']
+
+        assert not root['analysis']
+
+        for values in root['next'].values():
+
+            if values['pruned']:
+                assert values['analysis'] and not values['next']
+
+    def test_BioISO_nodes_cache_size(self):
+        self.startTime = time.time()
+
+        small_bio = BioISO(self.reaction_to_eval, self.m, self.objective, nodes_cache_size=10)
+        small_bio.run(self.level, self.fast)
+
+        assert self.tree == normalize_tree(small_bio.get_tree())
+
+        stats = small_bio.cache_stats
+
+        assert stats['size'] == 10 and stats['evictions'] > 0
+        assert stats['evictions'] == stats['misses'] + stats['harvested'] - stats['size']
+        assert stats['hits'] + stats['misses'] == self.bio.cache_stats['hits'] + self.bio.cache_stats['misses']
+
+        # the node cache is released once the instance is closed or garbage collected
+        instance = small_bio._BioISO__id
+        small_bio.close()
+
+        assert instance not in NodeCache.bioiso_instances
+
+        small_bio = BioISO(self.reaction_to_eval, self.m, self.objective, nodes_cache_size=10)
+        instance = small_bio._BioISO__id
+        del small_bio
+        gc.collect()
+
+        assert instance not in NodeCache.bioiso_instances
+
+    def test_BioISO_cache_store(self):
+        self.startTime = time.time()
+
+        cache_path = self.presults + 'BioISOCache' + self.model_name + '.sqlite'
+
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        bio = BioISO(self.reaction_to_eval, self.m, self.objective, cache_path=cache_path)
+        bio.run(self.level, self.fast)
+        bio.close()
+
+        # the second run reads every analysis from the store
+        store_bio = BioISO(self.reaction_to_eval, self.m, self.objective, cache_path=cache_path)
+        store_bio.run(self.level, self.fast)
+        store_bio.close()
+
+        assert normalize_tree(bio.get_tree()) == normalize_tree(store_bio.get_tree())
+        assert store_bio.cache_stats['misses'] == 0
+        assert store_bio.cache_stats['hits'] == bio.cache_stats['hits'] + bio.cache_stats['misses']
+
+        # the maximize LPs are solved in the direction of the model objective, so the store is not reused in the other
+        with self.m as m:
+            m.objective_direction = 'min'
+
+            min_bio = BioISO(self.reaction_to_eval, m, self.objective)
+            min_bio.run(self.level, self.fast)
+
+            store_min_bio = BioISO(self.reaction_to_eval, m, self.objective, cache_path=cache_path)
+            store_min_bio.run(self.level, self.fast)
+            store_min_bio.close()
+
+        assert store_min_bio.cache_stats['misses'] == min_bio.cache_stats['misses']
+        assert normalize_tree(min_bio.get_tree()) == normalize_tree(store_min_bio.get_tree())
+
+    def test_BioISO_shared_cache(self):
+        self.startTime = time.time()
+
+        knockout = 'R01978_C3_cytop'
+
+        bio = BioISO(self.reaction_to_eval, self.m, self.objective, shared_cache='knockouts',
+                     watched_reactions=[knockout])
+        bio.run(self.level, self.fast)
+
+        with self.m as m:
+            get_reaction(m, knockout).bounds = (0.0, 0.0)
+
+            ko_bio = BioISO(self.reaction_to_eval, m, self.objective)
+            ko_bio.run(self.level, self.fast)
+
+            shared_ko_bio = BioISO(self.reaction_to_eval, m, self.objective, shared_cache='knockouts',
+                                   watched_reactions=[knockout])
+            shared_ko_bio.run(self.level, self.fast)
+
+        # the analysis inferred from the run without the KO are the ones of a run with a fresh cache
+        assert shared_ko_bio.cache_stats['inferred'] > 0
+        assert normalize_tree(ko_bio.get_tree()) == normalize_tree(shared_ko_bio.get_tree())
+
+        # the maximize LPs are solved in the objective direction, so the analysis are not shared with the other one
+        with self.m as m:
+            m.objective_direction = 'min'
+
+            min_bio = BioISO(self.reaction_to_eval, m, self.objective)
+            min_bio.run(self.level, self.fast)
+
+            shared_min_bio = BioISO(self.reaction_to_eval, m, self.objective, shared_cache='knockouts',
+                                    watched_reactions=[knockout])
+            shared_min_bio.run(self.level, self.fast)
+
+        assert shared_min_bio.cache_stats['misses'] == min_bio.cache_stats['misses']
+        assert shared_min_bio.cache_stats['inferred'] == 0
+        assert normalize_tree(min_bio.get_tree()) == normalize_tree(shared_min_bio.get_tree())
+
+    def test_BioISO_scan_knockouts(self):
+        self.startTime = time.time()
+
+        kos = ['R00104_C3_cytop', 'R01978_C3_cytop']
+
+        scan_path = self.presults + 'scan/'
+        index_name = scan_index_name(scan_path, self.m, self.reaction_to_eval, self.objective)
+
+        if os.path.exists(index_name):
+            os.remove(index_name)
+
+        records = list(scan_knockouts(self.m, self.reaction_to_eval, self.objective, kos, self.level,
+                                      results_path=scan_path))
+
+        assert [record['ko'] for record in records] == kos
+
+        root = 'M_root_M_root_M_root_product'
+
+        for record in records:
+            assert load_results(record['results'])[root]['analysis'] == record['analysis']
+
+        assert not records[0]['analysis']
+
+        # the KOs in the index of the scan are not run again
+        assert list(scan_knockouts(self.m, self.reaction_to_eval, self.objective, kos, self.level,
+                                   results_path=scan_path)) == records
+
+        # unless the scan has other parameters
+        level_records = list(scan_knockouts(self.m, self.reaction_to_eval, self.objective, kos, self.level - 1,
+                                            results_path=scan_path))
+
+        for record, level_record in zip(records, level_records):
+            assert level_record['params']['levels'] == self.level - 1
+            assert level_record['total metabolites'] < record['total metabolites']
+            assert level_record['results'] != record['results']
+
+        assert list(scan_knockouts(self.m, self.reaction_to_eval, self.objective, kos, self.level,
+                                   results_path=scan_path)) == records
+
+    def test_BioISO_find_knockouts(self):
+        self.startTime = time.time()
+
+        with self.m as m:
+            set_objective_function(m, self.reaction_to_eval)
+
+            reactions_ids = [reaction.id for reaction in m.reactions]
+
+            lethal = find_knockouts(m, reactions_ids)
+
+            # the shares of the worker processes are merged back in the order of the reactions
+            assert find_knockouts(m, reactions_ids, processes=2) == lethal
+            assert find_knockouts(m, reactions_ids, max_lethal=5, processes=2) == lethal[:5]
+
+            deletions = single_reaction_deletion(m, reactions_ids, processes=1)
+
+        cobra_lethal = {reaction_id for ids, growth, status in deletions[['ids', 'growth', 'status']].values
+                        if status != 'optimal' or not growth >= 1E-08 for reaction_id in ids}
+
+        assert set(lethal) == cobra_lethal
+
+    def test_BioISO_find_knockouts_witness(self):
+        self.startTime = time.time()
+
+        def toy_model(reactions):
+
+            model = Model('toy')
+            metabolites = {metabolite_id: Metabolite(metabolite_id, compartment='c') for metabolite_id in 'ABC'}
+
+            for reaction_id, stoichiometry, bounds in reactions:
+                reaction = Reaction(reaction_id)
+                reaction.add_metabolites({metabolites[key]: value for key, value in stoichiometry.items()})
+                reaction.bounds = bounds
+
+                model.add_reactions([reaction])
+
+            model.objective = 'T'
+
+            return model
+
+        # the KO of X has an optimum of -5, which does not prove that the KO of S, without flux in it, is not lethal
+        sign_model = toy_model([('F', {'C': -1}, (0, 1000)),
+                                ('X', {'B': 1, 'C': 1}, (0, 5)),
+                                ('S', {'C': -1, 'B': 1}, (0, 1000)),
+                                ('T', {'B': -1}, (-5, 1000)),
+                                ('E', {'B': -1}, (5, 5))])
+
+        # the solution of the KO of X is not feasible in the KO of S, as the lower bound of X is positive
+        bounds_model = toy_model([('F', {'A': -1}, (5, 1000)),
+                                  ('X', {'A': -1}, (5, 1000)),
+                                  ('T', {'A': 1}, (0, 9)),
+                                  ('E', {'A': -1, 'B': -1}, (-5, 1000)),
+                                  ('S', {'A': -1, 'B': 1}, (-1000, 1000))])
+
+        for model in (sign_model, bounds_model):
+
+            reactions_ids = ['X', 'S', 'E', 'F']
+
+            deletions = single_reaction_deletion(model, reactions_ids, processes=1)
+
+            cobra_lethal = {reaction_id for ids, growth, status in deletions[['ids', 'growth', 'status']].values
+                            if status != 'optimal' or not abs(growth) > 1E-08 for reaction_id in ids}
+
+            assert 'S' in cobra_lethal
+            assert set(find_knockouts(model, reactions_ids)) == cobra_lethal
+
+    def test_BioISO_capabilities(self):
+        self.startTime = time.time()
+
+        capabilities = FluxCapabilities(self.m)
+
+        capabilities_bio = BioISO(self.reaction_to_eval, self.m, self.objective)
+        capabilities_bio.run(self.level, self.fast, capabilities=capabilities)
+
+        assert self.tree == normalize_tree(capabilities_bio.get_tree())
+        assert capabilities_bio.cache_stats['misses'] < self.bio.cache_stats['misses']
+
+        # the table is a snapshot of the model state
+        with self.m as m:
+            get_reaction(m, 'R00104_C3_cytop').bounds = (0.0, 0.0)
+
+            with self.assertRaises(ValueError):
+                BioISO(self.reaction_to_eval, m, self.objective).run(self.level, self.fast, capabilities=capabilities)
+
+        # including the objective direction, in which the maximize LPs are solved
+        with self.m as m:
+            m.objective_direction = 'min'
+
+            assert not capabilities.holds(m)
+
+    def test_BioISO_harvest(self):
+        self.startTime = time.time()
+
+        # the baseline run harvests its LP solutions
+        bio = BioISO(self.reaction_to_eval, self.m, self.objective, harvest=False)
+        bio.run(self.level, self.fast)
+
+        assert self.tree == normalize_tree(bio.get_tree())
+
+        # each harvested analysis used saves the LP of a reaction
+        stats = self.bio.cache_stats
+
+        assert stats['harvest hits'] > 0
+        assert stats['misses'] == bio.cache_stats['misses'] - stats['harvest hits']
+
+    def test_BioISO_harvest_bounded(self):
+        self.startTime = time.time()
+
+        bio = BioISO(self.reaction_to_eval, self.m, self.objective, nodes_cache_size=50, harvest=False)
+        bio.run(self.level, self.fast)
+
+        harvest_bio = BioISO(self.reaction_to_eval, self.m, self.objective, nodes_cache_size=50)
+        harvest_bio.run(self.level, self.fast)
+
+        assert normalize_tree(bio.get_tree()) == normalize_tree(harvest_bio.get_tree())
+
+        # harvested analysis only fill the free room of the cache, so they never evict solved LPs
+        stats = harvest_bio.cache_stats
+
+        assert stats['size'] == 50
+        assert 0 < stats['harvested'] <= 50
+        assert stats['harvest hits'] <= stats['harvested']
+        assert stats['evictions'] == stats['misses'] + stats['harvested'] - stats['size']
+        assert stats['hits'] >= bio.cache_stats['hits']
+        assert harvest_bio.nodes_cache.storage.harvested <= set(harvest_bio.nodes_cache.storage.analysis)
+
+    def test_BioISO_index_roles(self):
+        self.startTime = time.time()
+
+        # the model has forward, backward, reversible and blocked reactions
+        index = StoichiometricIndex(self.m)
+
+        for metabolite in self.m.metabolites:
+
+            for isReactant in (True, False):
+
+                roles = {reaction.id: maximize
+                         for reaction, maximize in get_reactions_roles(self.m, metabolite.id, isReactant)}
+
+                index_roles = {reaction.id: maximize
+                               for reaction, maximize in get_reactions_roles(self.m, metabolite.id, isReactant, index)}
+
+                assert roles == index_roles, (metabolite.id, isReactant)
+
+    def test_BioISO_prefilter(self):
+        self.startTime = time.time()
+
+        with self.m as m:
+            # the protein entity has no other producer
+            get_reaction(m, 'Protein_cytop').bounds = (0.0, 0.0)
+
+            bio = BioISO(self.reaction_to_eval, m, self.objective)
+            bio.run(self.level, self.fast)
+
+            prefilter_bio = BioISO(self.reaction_to_eval, m, self.objective)
+            prefilter_bio.run(self.level, self.fast, prefilter=True)
+
+        assert normalize_tree(bio.get_tree()) == normalize_tree(prefilter_bio.get_tree())
+        assert prefilter_bio.cache_stats['prefiltered'] > 0
+
+    def test_BioISO_screen(self):
+        self.startTime = time.time()
+
+        screen_bio = BioISO(self.reaction_to_eval, self.m, self.objective)
+        screen_bio.run(self.level, self.fast, screen=True)
+
+        assert self.tree == normalize_tree(screen_bio.get_tree())
+
+        # the nodes of each reaction are settled by fewer LPs than one for each node
+        stats = screen_bio.cache_stats
+
+        assert stats['screen lps'] < stats['screened']
+        assert stats['misses'] + stats['screen lps'] < self.bio.cache_stats['misses']
+
+    def test_BioISO_compress(self):
+        self.startTime = time.time()
+
+        compressed = CompressedModel(self.m)
+
+        stats = compressed.stats()
+
+        assert stats['compressed']['reactions'] < stats['original']['reactions']
+        assert stats['compressed']['metabolites'] < stats['original']['metabolites']
+
+        compress_bio = BioISO(self.reaction_to_eval, self.m, self.objective, compress=compressed)
+        compress_bio.run(self.level, self.fast, engine='solver')
+
+        # the results keep the identifiers of the model
+        assert self.tree == normalize_tree(compress_bio.get_tree())
+        assert compress_bio.cache_stats['blocked'] > 0
+
+        # the compressed model is rebuilt once the model state changes
+        with self.m as m:
+            get_reaction(m, 'R00104_C3_cytop').bounds = (0.0, 0.0)
+
+            compress_bio.run(self.level, self.fast)
+
+            assert compress_bio.compressed is not compressed and compress_bio.compressed.holds(m)
+
+        # and so it is once the objective direction changes, as the copy solves the maximize LPs in its direction
+        with self.m as m:
+            m.objective_direction = 'min'
+
+            assert not compressed.holds(m)
+
+            min_bio = BioISO(self.reaction_to_eval, m, self.objective)
+            min_bio.run(self.level, self.fast)
+
+            min_compress_bio = BioISO(self.reaction_to_eval, m, self.objective, compress=compressed)
+            min_compress_bio.run(self.level, self.fast, engine='solver')
+
+            assert min_compress_bio.compressed is not compressed
+            assert min_compress_bio.compressed.model.solver.objective.direction == 'min'
+
+        assert normalize_tree(min_bio.get_tree()) == normalize_tree(min_compress_bio.get_tree())
 
 
 if __name__ == '__main__':
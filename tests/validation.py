@@ -1,12 +1,10 @@
 import json
 import os
-import time
 import warnings
 
 import pandas as pd
 
-from bioiso import BioISO
-from bioiso import searchSpaceSize, bioisosearchSpaceSize
+from bioiso import scan_knockouts, load_results
 from bioiso import load, set_solver, set_objective_function, get_reaction, singleReactionKO
 
 warnings.filterwarnings("ignore")
@@ -161,7 +159,7 @@ compound_model_processing = {'iDS372': iDS372_compound,
                              'iOD907': iOD907_compound}
 
 
-def read_and_processing_models(path, solver, reactions, biomass=True):
+def read_and_processing_models(path, solver, reactions, biomass=True, results_path=None):
     print("Reading and processing models")
 
     models = {}
@@ -185,7 +183,8 @@ def read_and_processing_models(path, solver, reactions, biomass=True):
 
             set_solver(model, solver)
 
-            p = os.getcwd() + '/validation_results/GrowthCompoundRates' + model_name + '.txt'
+            p = os.path.join(results_path or os.path.join(os.getcwd(), 'validation_results'),
+                             'GrowthCompoundRates' + model_name + '.txt')
 
             if biomass:
 
@@ -212,7 +211,11 @@ def read_and_processing_models(path, solver, reactions, biomass=True):
     return models
 
 
-def pipeline(models_path, reactions, objectives, biomass=True, solver='cplex', level=2, fast=False):
+def pipeline(models_path, reactions, objectives, biomass=True, solver='cplex', level=2, fast=False, workers=1,
+             results_path=None, failures=None):
+    # the results are written to results_path (validation_results in the working directory by default)
+    # the KOs and models that failed are written to the results path, and collected in the failures dict if given
+
     if not isinstance(reactions, dict):
         raise TypeError("reactions arg must be an {}".format(dict.__name__))
 
@@ -222,12 +225,13 @@ def pipeline(models_path, reactions, objectives, biomass=True, solver='cplex', l
     if not isinstance(level, int):
         raise TypeError("level arg must be an {}".format(int.__name__))
 
-    results_path = os.path.join(os.getcwd(), 'validation_results')
+    if results_path is None:
+        results_path = os.path.join(os.getcwd(), 'validation_results')
 
     if not os.path.exists(results_path):
-        os.mkdir(results_path)
+        os.makedirs(results_path)
 
-    models = read_and_processing_models(models_path, solver, reactions, biomass=biomass)
+    models = read_and_processing_models(models_path, solver, reactions, biomass=biomass, results_path=results_path)
 
     if len(models) != len(reactions) or len(models) != len(objectives) or len(reactions) != len(objectives):
         raise ValueError("models, reactions and objectives args must have the same length. "
@@ -238,6 +242,9 @@ def pipeline(models_path, reactions, objectives, biomass=True, solver='cplex', l
 
     models_kos = {}
 
+    if failures is None:
+        failures = {}
+
     print()
     print('Getting KOs')
 
@@ -260,6 +267,7 @@ def pipeline(models_path, reactions, objectives, biomass=True, solver='cplex', l
         except ValueError as e:
 
             print("KO Error for {} model with exception {}".format(modelKey, e))
+            failures[modelKey] = {'kos': repr(e)}
 
     print()
     print('KOs are ready for {} models'.format(str(len(models_kos))))
@@ -272,47 +280,41 @@ def pipeline(models_path, reactions, objectives, biomass=True, solver='cplex', l
         trees[modelKey] = {}
         results[modelKey] = {}
 
-        for ko in models_kos[modelKey]:
-            print("Starting BioISO with model {}, "
-                  "reaction {} "
-                  "and objective {} "
-                  "for ko {}".format(modelKey, reactions[modelKey], objectives[modelKey], ko))
-
-            results[modelKey][ko] = {}
+        print("Starting BioISO with model {}, "
+              "reaction {} "
+              "and objective {} "
+              "for {} kos".format(modelKey, reactions[modelKey], objectives[modelKey], len(models_kos[modelKey])))
 
-            t0 = time.time()
+        # the KOs are run by the knockout scan, which writes the results of each KO to the results path
+        scan = scan_knockouts(models[modelKey], reactions[modelKey], objectives[modelKey], models_kos[modelKey],
+                              level, workers=workers, fast=fast, results_path=results_path)
 
-            with models[modelKey] as m:
-                m.reactions.get_by_id(ko).bounds = (0.0, 0.0)
+        for record in scan:
 
-                bio = BioISO(reactions[modelKey], m, objectives[modelKey])
-                bio.run(level, fast)
+            ko = record['ko']
 
-                t1 = time.time()
+            if 'error' in record:
+                print("BioISO Error for ko {} with exception {}".format(ko, record['error']))
+                failures.setdefault(modelKey, {})[ko] = record['error']
+                continue
 
-                tree = bio.get_tree()
+            trees[modelKey][ko] = load_results(record['results'])
 
-                trees[modelKey][ko] = tree
+            # search space of the tree, which is counted while populated
+            results[modelKey][ko] = {'time': record['time']}
+            results[modelKey][ko].update({key: record[key] for key in ('total reactions', 'total metabolites',
+                                                                       'bioiso reactions', 'bioiso metabolites')})
 
-                f_name = results_path + '\{}_{}_{}_{}.json'.format(modelKey, ko, reactions[modelKey],
-                                                                   objectives[modelKey])
+            print("BioISO has finished ko {} with running time of {}".format(ko, str(record['time'])))
 
-                bio.write_results(f_name)
-
-                results[modelKey][ko].update({'time': float(t1 - t0)})
-
-            print("BioISO has finished with running time of {}".format(str(t1 - t0)))
-            print("")
+        print("")
 
     print()
-    print('Getting BioISO statistics for {} models'.format(str(len(trees))))
+    print('Writing BioISO trees for {} models'.format(str(len(trees))))
 
     for modelKey in trees:
 
         for ko in trees[modelKey]:
-            total_reactions, total_metabolites = searchSpaceSize(trees[modelKey][ko])
-            bioiso_reactions, bioiso_metabolites = bioisosearchSpaceSize(trees[modelKey][ko])
-
             results_fname = results_path + '\{}_{}_{}_{}_search_space.json'.format(modelKey,
                                                                                    ko,
                                                                                    reactions[modelKey],
@@ -321,25 +323,23 @@ def pipeline(models_path, reactions, objectives, biomass=True, solver='cplex', l
             with open(results_fname, "w") as jsonfile:
                 json.dump(trees[modelKey][ko], jsonfile)
 
-            results[modelKey][ko].update({
-                'total reactions': total_reactions,
-                'total metabolites': total_metabolites,
-                'bioiso reactions': bioiso_reactions,
-                'bioiso metabolites': bioiso_metabolites,
-            })
-
     print()
     print('Writing ...')
 
-    f_name = '_'.join([key[0:5] if len(key) > 5 else key for key in reactions.values()])
+    name = '_'.join([key[0:5] if len(key) > 5 else key for key in reactions.values()])
 
-    f_name = results_path + '/' + f_name + '_bioiso.xlsx'
+    f_name = results_path + '/' + name + '_bioiso.xlsx'
 
     dfs = []
 
     with pd.ExcelWriter(f_name) as writer:
 
         for modelKey in results:
+
+            # models whose KOs all failed are only in the failures
+            if not results[modelKey]:
+                continue
+
             rows = list(results[modelKey].keys())
             cols = list(results[modelKey][rows[0]].keys())
             data = [[metric for metric in results[modelKey][ko].values()] for ko in results[modelKey]]
@@ -348,6 +348,12 @@ def pipeline(models_path, reactions, objectives, biomass=True, solver='cplex', l
             df.to_excel(writer, sheet_name=modelKey)
             dfs.append(df)
 
+    with open(os.path.join(results_path, name + '_failures.json'), "w") as jsonfile:
+        json.dump(failures, jsonfile)
+
+    if failures:
+        print('Failures in {} models, see {}'.format(str(len(failures)), jsonfile.name))
+
     print()
     print('Ready ...')
 